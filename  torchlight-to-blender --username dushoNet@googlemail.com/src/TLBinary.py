@@ -0,0 +1,738 @@
+"""
+Name: 'OGRE binary serializers for Torchlight'
+Blender: 2.59, 2.62, 2.63a
+
+Author: Dusho
+
+Reads Ogre binary .mesh and .skeleton chunks directly, so the import doesn't
+have to go through OgreXMLConverter and temporary .xml files. Binary .mesh
+and .skeleton files are also written directly on export.
+
+Supported versions:
+    * [MeshSerializer_v1.30]
+    * [MeshSerializer_v1.40] - Ogre 1.6.x (Torchlight 1)
+    * [MeshSerializer_v1.41] - Ogre 1.7.x (Torchlight 2)
+    * [Serializer_v1.10]     - skeletons of both Torchlight 1 and 2
+
+Data are returned (and expected by writers) in Ogre space (no axis
+swapping), vertex elements are decoded into flat per-element lists:
+OGREMESH:
+['version'] - serializer version string
+['skeletonlink'] - name of linked .skeleton file (if any)
+['sharedgeometry'] - GEOMETRY (if any)
+['boneassignments'] - BONEASSIGNMENTS for shared geometry
+['submeshes'][idx]
+    ['material'] - material name
+    ['usesharedvertices'] - True/False
+    ['operationtype'] - OT_* value
+    ['indices'] - flat list of vertex indices
+    ['geometry'] - GEOMETRY (if not using shared vertices)
+    ['boneassignments'] - BONEASSIGNMENTS
+['submeshnames'] - {index: name}
+['bounds'] - [minx, miny, minz, maxx, maxy, maxz, radius] (calculated from
+             positions when writing, if missing)
+GEOMETRY:
+['vertexcount'] - number of vertices
+['elements'] - [(semantic, index, components, values), ..] where values are
+               flat floats (components per vertex)
+BONEASSIGNMENTS:
+    (vertexIndices, boneIndices, weights) - parallel arrays
+OGRESKELETON:
+['version'] - serializer version string
+['bones'] - list of BONE
+['parents'] - {bone handle: parent bone handle}
+['animations'] - list of ANIMATION
+['animationlinks'] - [(skeleton name, scale), ..]
+BONE:
+['name'], ['id'] - bone name and handle
+['position'] - [x,y,z]
+['orientation'] - quaternion [w,x,y,z]
+['scale'] - [x,y,z]
+ANIMATION:
+['name'], ['length'] - animation name and length in seconds
+['offset'] - offset of animation chunk in file (for readAnimationAt)
+['tracks'] - {bone handle: list of KEYFRAME} (None if animations weren't loaded)
+KEYFRAME:
+    (time, rotate [w,x,y,z], translate [x,y,z], scale [x,y,z])
+"""
+
+from array import array
+import struct
+import sys
+
+# chunk IDs (OgreMeshFileFormat.h)
+M_HEADER = 0x1000
+M_MESH = 0x3000
+M_SUBMESH = 0x4000
+M_SUBMESH_OPERATION = 0x4010
+M_SUBMESH_BONE_ASSIGNMENT = 0x4100
+M_SUBMESH_TEXTURE_ALIAS = 0x4200
+M_GEOMETRY = 0x5000
+M_GEOMETRY_VERTEX_DECLARATION = 0x5100
+M_GEOMETRY_VERTEX_ELEMENT = 0x5110
+M_GEOMETRY_VERTEX_BUFFER = 0x5200
+M_GEOMETRY_VERTEX_BUFFER_DATA = 0x5210
+M_MESH_SKELETON_LINK = 0x6000
+M_MESH_BONE_ASSIGNMENT = 0x7000
+M_MESH_LOD = 0x8000
+M_MESH_BOUNDS = 0x9000
+M_SUBMESH_NAME_TABLE = 0xA000
+M_SUBMESH_NAME_TABLE_ELEMENT = 0xA100
+M_EDGE_LISTS = 0xB000
+M_POSES = 0xC000
+M_ANIMATIONS = 0xD000
+M_TABLE_EXTREMES = 0xE000
+
+# chunk IDs (OgreSkeletonFileFormat.h)
+SKELETON_HEADER = 0x1000
+SKELETON_BLENDMODE = 0x1010
+SKELETON_BONE = 0x2000
+SKELETON_BONE_PARENT = 0x3000
+SKELETON_ANIMATION = 0x4000
+SKELETON_ANIMATION_BASEINFO = 0x4010
+SKELETON_ANIMATION_TRACK = 0x4100
+SKELETON_ANIMATION_TRACK_KEYFRAME = 0x4110
+SKELETON_ANIMATION_LINK = 0x5000
+
+# size of chunk id + chunk length
+CHUNK_OVERHEAD = 6
+
+MESH_VERSION_TL1 = "[MeshSerializer_v1.40]"
+MESH_VERSION_TL2 = "[MeshSerializer_v1.41]"
+MESH_VERSIONS = ("[MeshSerializer_v1.30]", MESH_VERSION_TL1, MESH_VERSION_TL2)
+
+SKELETON_VERSION = "[Serializer_v1.10]"
+SKELETON_VERSIONS = (SKELETON_VERSION, "[Serializer_v1.80]")
+
+# vertex element types (OgreHardwareVertexBuffer.h)
+VET_FLOAT1 = 0
+VET_FLOAT2 = 1
+VET_FLOAT3 = 2
+VET_FLOAT4 = 3
+VET_COLOUR = 4
+VET_SHORT1 = 5
+VET_SHORT2 = 6
+VET_SHORT3 = 7
+VET_SHORT4 = 8
+VET_UBYTE4 = 9
+VET_COLOUR_ARGB = 10
+VET_COLOUR_ABGR = 11
+
+# vertex element semantics
+VES_POSITION = 1
+VES_BLEND_WEIGHTS = 2
+VES_BLEND_INDICES = 3
+VES_NORMAL = 4
+VES_DIFFUSE = 5
+VES_SPECULAR = 6
+VES_TEXTURE_COORDINATES = 7
+VES_BINORMAL = 8
+VES_TANGENT = 9
+
+# render operation types
+OT_POINT_LIST = 1
+OT_LINE_LIST = 2
+OT_LINE_STRIP = 3
+OT_TRIANGLE_LIST = 4
+OT_TRIANGLE_STRIP = 5
+OT_TRIANGLE_FAN = 6
+
+# element type: (struct code, number of components)
+VERTEX_ELEMENT_FORMATS = {
+    VET_FLOAT1: ('f', 1),
+    VET_FLOAT2: ('f', 2),
+    VET_FLOAT3: ('f', 3),
+    VET_FLOAT4: ('f', 4),
+    VET_COLOUR: ('I', 1),
+    VET_SHORT1: ('h', 1),
+    VET_SHORT2: ('h', 2),
+    VET_SHORT3: ('h', 3),
+    VET_SHORT4: ('h', 4),
+    VET_UBYTE4: ('B', 4),
+    VET_COLOUR_ARGB: ('I', 1),
+    VET_COLOUR_ABGR: ('I', 1),
+    }
+
+class OgreBinaryError(Exception):
+    pass
+
+class OgreBinaryReader(object):
+    ''' Reads Ogre serializer primitives from an in-memory file. '''
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.endian = '<'
+
+    def eof(self):
+        return self.pos >= len(self.data)
+
+    def unpack(self, fmt, size):
+        if self.pos + size > len(self.data):
+            raise OgreBinaryError("Unexpected end of file")
+        values = struct.unpack_from(self.endian + fmt, self.data, self.pos)
+        self.pos += size
+        return values
+
+    def readHeader(self):
+        # header id tells us the endianness of the file
+        (headerID,) = struct.unpack_from('<H', self.data, 0)
+        if headerID == M_HEADER:
+            self.endian = '<'
+        elif headerID == 0x0010:
+            self.endian = '>'
+        else:
+            raise OgreBinaryError("Not an Ogre binary file")
+        self.pos = 2
+        return self.readString()
+
+    def readChunk(self):
+        # returns (chunkID, chunkLength), chunkLength includes chunk overhead
+        return self.unpack('HI', CHUNK_OVERHEAD)
+
+    def peekChunkID(self):
+        if self.pos + CHUNK_OVERHEAD > len(self.data):
+            return None
+        return struct.unpack_from(self.endian + 'H', self.data, self.pos)[0]
+
+    def skip(self, size):
+        self.pos += size
+
+    def readString(self):
+        # strings are terminated with new line
+        end = self.data.find(b'\n', self.pos)
+        if end < 0:
+            raise OgreBinaryError("Unterminated string")
+        value = self.data[self.pos:end].decode('utf-8', 'replace')
+        self.pos = end + 1
+        return value
+
+    def readBool(self):
+        return self.unpack('B', 1)[0] != 0
+
+    def readUShort(self):
+        return self.unpack('H', 2)[0]
+
+    def readUInt(self):
+        return self.unpack('I', 4)[0]
+
+    def readFloats(self, count):
+        return self.unpack('%df' % count, 4 * count)
+
+    def readArray(self, typecode, count):
+        values = array(typecode)
+        size = values.itemsize * count
+        if self.pos + size > len(self.data):
+            raise OgreBinaryError("Unexpected end of file")
+        values.frombytes(self.data[self.pos:self.pos + size])
+        if self.endian != ('<' if sys.byteorder == 'little' else '>'):
+            values.byteswap()
+        self.pos += size
+        return values
+
+    def readBytes(self, size):
+        if self.pos + size > len(self.data):
+            raise OgreBinaryError("Unexpected end of file")
+        value = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return value
+
+def bufferColumns(reader, buffer, vertexSize, vertexCount, offset, elemType):
+    # returns list of columns (one per component) for one vertex element
+    code, comps = VERTEX_ELEMENT_FORMATS[elemType]
+    columns = []
+    if code in ('f', 'I') and vertexSize % 4 == 0 and offset % 4 == 0:
+        # fast path: look at the whole buffer as 32bit values and take
+        # every n-th value
+        values = array(code)
+        values.frombytes(buffer)
+        if reader.endian != ('<' if sys.byteorder == 'little' else '>'):
+            values.byteswap()
+        stride = vertexSize // 4
+        base = offset // 4
+        for c in range(comps):
+            columns.append(values[base + c::stride])
+    else:
+        vertexFormat = struct.Struct(reader.endian + code * comps)
+        rows = [vertexFormat.unpack_from(buffer, i * vertexSize + offset)
+                for i in range(vertexCount)]
+        for c in range(comps):
+            columns.append([row[c] for row in rows])
+    return columns
+
+def decodeColours(packed, elemType):
+    # packed 32bit colours -> r,g,b,a columns (0.0 - 1.0)
+    if elemType == VET_COLOUR_ABGR:
+        rShift, bShift = 0, 16
+    else:
+        # VET_COLOUR is taken as D3D (ARGB) which is used by Torchlight
+        rShift, bShift = 16, 0
+    r = [((c >> rShift) & 0xFF) / 255.0 for c in packed]
+    g = [((c >> 8) & 0xFF) / 255.0 for c in packed]
+    b = [((c >> bShift) & 0xFF) / 255.0 for c in packed]
+    a = [((c >> 24) & 0xFF) / 255.0 for c in packed]
+    return [r, g, b, a]
+
+def interleave(columns, vertexCount):
+    comps = len(columns)
+    values = [0.0] * (vertexCount * comps)
+    for c, column in enumerate(columns):
+        values[c::comps] = column
+    return values
+
+def readGeometry(reader):
+    geometry = {}
+    vertexCount = reader.readUInt()
+    declaration = []
+    buffers = {}
+
+    while True:
+        chunkID = reader.peekChunkID()
+        if chunkID == M_GEOMETRY_VERTEX_DECLARATION:
+            reader.readChunk()
+            while reader.peekChunkID() == M_GEOMETRY_VERTEX_ELEMENT:
+                reader.readChunk()
+                # source, type, semantic, offset, index
+                declaration.append(reader.unpack('5H', 10))
+        elif chunkID == M_GEOMETRY_VERTEX_BUFFER:
+            reader.readChunk()
+            bindIndex = reader.readUShort()
+            vertexSize = reader.readUShort()
+            dataID, dataLength = reader.readChunk()
+            if dataID != M_GEOMETRY_VERTEX_BUFFER_DATA:
+                raise OgreBinaryError("Missing vertex buffer data")
+            buffers[bindIndex] = (vertexSize, reader.readBytes(vertexSize * vertexCount))
+        else:
+            break
+
+    elements = []
+    for source, elemType, semantic, offset, index in declaration:
+        if source not in buffers:
+            print("WARNING: Vertex element without buffer (source %d)" % source)
+            continue
+        if elemType not in VERTEX_ELEMENT_FORMATS:
+            print("WARNING: Unknown vertex element type %d" % elemType)
+            continue
+        vertexSize, buffer = buffers[source]
+        columns = bufferColumns(reader, buffer, vertexSize, vertexCount, offset, elemType)
+        if elemType in (VET_COLOUR, VET_COLOUR_ARGB, VET_COLOUR_ABGR):
+            columns = decodeColours(columns[0], elemType)
+        elements.append((semantic, index, len(columns), interleave(columns, vertexCount)))
+
+    geometry['vertexcount'] = vertexCount
+    geometry['elements'] = elements
+    return geometry
+
+def newBoneAssignments():
+    # vertex indices, bone indices, weights
+    return (array('I'), array('H'), array('f'))
+
+def readBoneAssignment(reader, boneAssignments):
+    verti, boneIndex, weight = reader.unpack('IHf', 10)
+    boneAssignments[0].append(verti)
+    boneAssignments[1].append(boneIndex)
+    boneAssignments[2].append(weight)
+
+def triangulateIndices(indices, operationType):
+    # converts strips and fans to triangle list
+    if operationType == OT_TRIANGLE_STRIP:
+        triangles = []
+        for i in range(len(indices) - 2):
+            if i % 2 == 0:
+                triangles.extend((indices[i], indices[i+1], indices[i+2]))
+            else:
+                triangles.extend((indices[i+1], indices[i], indices[i+2]))
+        return triangles
+    elif operationType == OT_TRIANGLE_FAN:
+        triangles = []
+        for i in range(1, len(indices) - 1):
+            triangles.extend((indices[0], indices[i], indices[i+1]))
+        return triangles
+    return indices
+
+def readSubMesh(reader):
+    subMesh = {}
+    subMesh['material'] = reader.readString()
+    subMesh['usesharedvertices'] = reader.readBool()
+    indexCount = reader.readUInt()
+    indexes32Bit = reader.readBool()
+    if indexes32Bit:
+        subMesh['indices'] = reader.readArray('I', indexCount)
+    else:
+        subMesh['indices'] = reader.readArray('H', indexCount)
+    subMesh['operationtype'] = OT_TRIANGLE_LIST
+    subMesh['boneassignments'] = newBoneAssignments()
+
+    while True:
+        chunkID = reader.peekChunkID()
+        if chunkID == M_GEOMETRY:
+            reader.readChunk()
+            subMesh['geometry'] = readGeometry(reader)
+        elif chunkID == M_SUBMESH_OPERATION:
+            reader.readChunk()
+            subMesh['operationtype'] = reader.readUShort()
+        elif chunkID == M_SUBMESH_BONE_ASSIGNMENT:
+            reader.readChunk()
+            readBoneAssignment(reader, subMesh['boneassignments'])
+        elif chunkID == M_SUBMESH_TEXTURE_ALIAS:
+            chunkID, chunkLength = reader.readChunk()
+            reader.skip(chunkLength - CHUNK_OVERHEAD)
+        else:
+            break
+
+    subMesh['indices'] = triangulateIndices(subMesh['indices'], subMesh['operationtype'])
+    return subMesh
+
+def openReader(filepath):
+    filein = open(filepath, 'rb')
+    try:
+        data = filein.read()
+    finally:
+        filein.close()
+
+    if len(data) < CHUNK_OVERHEAD:
+        raise OgreBinaryError("File too short")
+
+    return OgreBinaryReader(data)
+
+def readMesh(filepath):
+
+    reader = openReader(filepath)
+    version = reader.readHeader()
+    if version not in MESH_VERSIONS:
+        raise OgreBinaryError("Unsupported mesh version %s" % version)
+
+    ogreMesh = {}
+    ogreMesh['version'] = version
+    ogreMesh['submeshes'] = []
+    ogreMesh['boneassignments'] = newBoneAssignments()
+    ogreMesh['submeshnames'] = {}
+
+    chunkID, chunkLength = reader.readChunk()
+    if chunkID != M_MESH:
+        raise OgreBinaryError("Missing mesh chunk")
+    # skeletally animated flag
+    reader.readBool()
+
+    while not reader.eof():
+        chunkID, chunkLength = reader.readChunk()
+        if chunkID == M_GEOMETRY:
+            ogreMesh['sharedgeometry'] = readGeometry(reader)
+        elif chunkID == M_SUBMESH:
+            ogreMesh['submeshes'].append(readSubMesh(reader))
+        elif chunkID == M_MESH_SKELETON_LINK:
+            ogreMesh['skeletonlink'] = reader.readString()
+        elif chunkID == M_MESH_BONE_ASSIGNMENT:
+            readBoneAssignment(reader, ogreMesh['boneassignments'])
+        elif chunkID == M_MESH_BOUNDS:
+            ogreMesh['bounds'] = list(reader.readFloats(7))
+        elif chunkID == M_SUBMESH_NAME_TABLE:
+            while reader.peekChunkID() == M_SUBMESH_NAME_TABLE_ELEMENT:
+                reader.readChunk()
+                index = reader.readUShort()
+                ogreMesh['submeshnames'][index] = reader.readString()
+        else:
+            # LOD, edge lists, poses, animations, ... are not used
+            if chunkLength < CHUNK_OVERHEAD:
+                raise OgreBinaryError("Invalid chunk length")
+            reader.skip(chunkLength - CHUNK_OVERHEAD)
+
+    return ogreMesh
+
+def readBone(reader, chunkStart, chunkLength):
+    bone = {}
+    bone['name'] = reader.readString()
+    bone['id'] = reader.readUShort()
+    bone['position'] = list(reader.readFloats(3))
+    x, y, z, w = reader.readFloats(4)
+    bone['orientation'] = [w, x, y, z]
+    bone['scale'] = [1.0, 1.0, 1.0]
+    # scale is there only if it's not unit scale
+    if reader.pos < chunkStart + chunkLength:
+        bone['scale'] = list(reader.readFloats(3))
+    return bone
+
+def readKeyFrame(reader, chunkStart, chunkLength):
+    (time,) = reader.readFloats(1)
+    x, y, z, w = reader.readFloats(4)
+    translate = list(reader.readFloats(3))
+    scale = [1.0, 1.0, 1.0]
+    if reader.pos < chunkStart + chunkLength:
+        scale = list(reader.readFloats(3))
+    return (time, [w, x, y, z], translate, scale)
+
+def readAnimation(reader):
+    animation = {}
+    animation['name'] = reader.readString()
+    (animation['length'],) = reader.readFloats(1)
+    tracks = {}
+    animation['tracks'] = tracks
+
+    if reader.peekChunkID() == SKELETON_ANIMATION_BASEINFO:
+        chunkID, chunkLength = reader.readChunk()
+        reader.skip(chunkLength - CHUNK_OVERHEAD)
+
+    while reader.peekChunkID() == SKELETON_ANIMATION_TRACK:
+        reader.readChunk()
+        boneHandle = reader.readUShort()
+        keyFrames = []
+        while reader.peekChunkID() == SKELETON_ANIMATION_TRACK_KEYFRAME:
+            chunkStart = reader.pos
+            chunkID, chunkLength = reader.readChunk()
+            keyFrames.append(readKeyFrame(reader, chunkStart, chunkLength))
+        tracks[boneHandle] = keyFrames
+
+    return animation
+
+def readAnimationAt(filepath, offset):
+    # reads one animation, which chunk starts at offset (see readSkeleton)
+    reader = openReader(filepath)
+    reader.readHeader()
+    reader.pos = offset
+    chunkID, chunkLength = reader.readChunk()
+    if chunkID != SKELETON_ANIMATION:
+        raise OgreBinaryError("No animation at offset %d" % offset)
+    animation = readAnimation(reader)
+    animation['offset'] = offset
+    return animation
+
+def readSkeleton(filepath, loadAnimations=True):
+    # with loadAnimations=False only name, length and offset of animations
+    # are read, keyframes are skipped
+
+    reader = openReader(filepath)
+    version = reader.readHeader()
+    if version not in SKELETON_VERSIONS:
+        raise OgreBinaryError("Unsupported skeleton version %s" % version)
+
+    ogreSkeleton = {}
+    ogreSkeleton['version'] = version
+    ogreSkeleton['bones'] = []
+    ogreSkeleton['parents'] = {}
+    ogreSkeleton['animations'] = []
+    ogreSkeleton['animationlinks'] = []
+
+    while not reader.eof():
+        chunkStart = reader.pos
+        chunkID, chunkLength = reader.readChunk()
+        if chunkID == SKELETON_BONE:
+            ogreSkeleton['bones'].append(readBone(reader, chunkStart, chunkLength))
+        elif chunkID == SKELETON_BONE_PARENT:
+            boneHandle = reader.readUShort()
+            parentHandle = reader.readUShort()
+            ogreSkeleton['parents'][boneHandle] = parentHandle
+        elif chunkID == SKELETON_ANIMATION:
+            if loadAnimations:
+                animation = readAnimation(reader)
+            else:
+                animation = {}
+                animation['name'] = reader.readString()
+                (animation['length'],) = reader.readFloats(1)
+                animation['tracks'] = None
+                reader.pos = chunkStart + chunkLength
+            animation['offset'] = chunkStart
+            ogreSkeleton['animations'].append(animation)
+        elif chunkID == SKELETON_ANIMATION_LINK:
+            skeletonName = reader.readString()
+            (scale,) = reader.readFloats(1)
+            ogreSkeleton['animationlinks'].append((skeletonName, scale))
+        else:
+            # blend mode, ...
+            if chunkLength < CHUNK_OVERHEAD:
+                raise OgreBinaryError("Invalid chunk length")
+            reader.skip(chunkLength - CHUNK_OVERHEAD)
+
+    return ogreSkeleton
+
+def packString(value):
+    return value.encode('utf-8') + b'\n'
+
+def packChunk(chunkID, body):
+    return struct.pack('<HI', chunkID, len(body) + CHUNK_OVERHEAD) + body
+
+def packColours(values):
+    # r,g,b,a floats -> packed ARGB
+    packed = array('I')
+    for i in range(0, len(values), 4):
+        r, g, b, a = [int(round(max(0.0, min(1.0, c))*255.0)) for c in values[i:i+4]]
+        packed.append((a << 24) | (r << 16) | (g << 8) | b)
+    return packed
+
+def packGeometry(geometry, skeletallyAnimated):
+    vertexCount = geometry['vertexcount']
+
+    # same layout as Ogre's auto organised declaration, animated elements
+    # (positions and normals) are in separate buffer for skinned meshes
+    sourceElements = {}
+    for semantic, index, comps, values in geometry['elements']:
+        source = 0
+        if skeletallyAnimated and semantic not in (VES_POSITION, VES_NORMAL):
+            source = 1
+        sourceElements.setdefault(source, []).append((semantic, index, comps, values))
+
+    declaration = []
+    buffers = []
+    for source, elements in enumerate([sourceElements[k] for k in sorted(sourceElements)]):
+        # buffers are built from 32bit words
+        layout = []
+        stride = 0
+        for semantic, index, comps, values in elements:
+            if semantic in (VES_DIFFUSE, VES_SPECULAR) and comps == 4:
+                elemType = VET_COLOUR_ARGB
+                words = 1
+            else:
+                elemType = VET_FLOAT1 + comps - 1
+                words = comps
+            declaration.append(packChunk(M_GEOMETRY_VERTEX_ELEMENT,
+                struct.pack('<5H', source, elemType, semantic, stride*4, index)))
+            layout.append((stride, elemType, comps, values))
+            stride += words
+
+        data = array('I', [0]) * (vertexCount * stride)
+        for offset, elemType, comps, values in layout:
+            if elemType == VET_COLOUR_ARGB:
+                data[offset::stride] = packColours(values)
+            else:
+                for c in range(comps):
+                    column = array('I')
+                    column.frombytes(array('f', values[c::comps]).tobytes())
+                    data[offset+c::stride] = column
+        if sys.byteorder != 'little':
+            data.byteswap()
+        buffers.append(packChunk(M_GEOMETRY_VERTEX_BUFFER,
+            struct.pack('<HH', source, stride*4) +
+            packChunk(M_GEOMETRY_VERTEX_BUFFER_DATA, data.tobytes())))
+
+    body = [struct.pack('<I', vertexCount),
+            packChunk(M_GEOMETRY_VERTEX_DECLARATION, b''.join(declaration))]
+    body.extend(buffers)
+    return packChunk(M_GEOMETRY, b''.join(body))
+
+def packBoneAssignments(chunkID, boneAssignments):
+    return b''.join([packChunk(chunkID, struct.pack('<IHf', verti, boneIndex, weight))
+                     for verti, boneIndex, weight in zip(*boneAssignments)])
+
+def packIndices(indices, vertexCount):
+    if vertexCount > 65535:
+        values = array('I', indices)
+    else:
+        values = array('H', indices)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values.tobytes()
+
+def packSubMesh(subMesh, sharedGeometry, skeletallyAnimated):
+    useShared = subMesh['usesharedvertices']
+    if useShared:
+        vertexCount = sharedGeometry['vertexcount']
+    else:
+        vertexCount = subMesh['geometry']['vertexcount']
+    indices = subMesh['indices']
+
+    body = [packString(subMesh['material']),
+            struct.pack('<?I?', useShared, len(indices), vertexCount > 65535),
+            packIndices(indices, vertexCount)]
+    if not useShared:
+        body.append(packGeometry(subMesh['geometry'], skeletallyAnimated))
+    body.append(packChunk(M_SUBMESH_OPERATION, struct.pack('<H', OT_TRIANGLE_LIST)))
+    body.append(packBoneAssignments(M_SUBMESH_BONE_ASSIGNMENT,
+                                    subMesh.get('boneassignments', newBoneAssignments())))
+    return packChunk(M_SUBMESH, b''.join(body))
+
+def calcBounds(ogreMesh):
+    geometries = [sm['geometry'] for sm in ogreMesh['submeshes'] if 'geometry' in sm]
+    if 'sharedgeometry' in ogreMesh:
+        geometries.append(ogreMesh['sharedgeometry'])
+    minimum = [float('inf')] * 3
+    maximum = [float('-inf')] * 3
+    sqrRadius = 0.0
+    for geometry in geometries:
+        for semantic, index, comps, values in geometry['elements']:
+            if semantic != VES_POSITION or len(values) == 0:
+                continue
+            for c in range(3):
+                minimum[c] = min(minimum[c], min(values[c::3]))
+                maximum[c] = max(maximum[c], max(values[c::3]))
+            for i in range(0, len(values), 3):
+                sqrRadius = max(sqrRadius, values[i]**2 + values[i+1]**2 + values[i+2]**2)
+    if minimum[0] > maximum[0]:
+        minimum = [0.0] * 3
+        maximum = [0.0] * 3
+    return minimum + maximum + [sqrRadius ** 0.5]
+
+def writeMesh(filepath, ogreMesh, version=MESH_VERSION_TL1):
+
+    if version not in MESH_VERSIONS:
+        raise OgreBinaryError("Unsupported mesh version %s" % version)
+
+    skeletallyAnimated = 'skeletonlink' in ogreMesh
+    sharedGeometry = ogreMesh.get('sharedgeometry')
+
+    body = [struct.pack('<?', skeletallyAnimated)]
+    if sharedGeometry is not None:
+        body.append(packGeometry(sharedGeometry, skeletallyAnimated))
+    for subMesh in ogreMesh['submeshes']:
+        body.append(packSubMesh(subMesh, sharedGeometry, skeletallyAnimated))
+    if skeletallyAnimated:
+        body.append(packChunk(M_MESH_SKELETON_LINK, packString(ogreMesh['skeletonlink'])))
+    body.append(packBoneAssignments(M_MESH_BONE_ASSIGNMENT,
+                                    ogreMesh.get('boneassignments', newBoneAssignments())))
+    bounds = ogreMesh.get('bounds') or calcBounds(ogreMesh)
+    body.append(packChunk(M_MESH_BOUNDS, struct.pack('<7f', *bounds)))
+    subMeshNames = ogreMesh.get('submeshnames', {})
+    if len(subMeshNames) > 0:
+        body.append(packChunk(M_SUBMESH_NAME_TABLE, b''.join(
+            [packChunk(M_SUBMESH_NAME_TABLE_ELEMENT, struct.pack('<H', index) + packString(name))
+             for index, name in sorted(subMeshNames.items())])))
+
+    fileWr = open(filepath, 'wb')
+    try:
+        fileWr.write(struct.pack('<H', M_HEADER) + packString(version))
+        fileWr.write(packChunk(M_MESH, b''.join(body)))
+    finally:
+        fileWr.close()
+
+def packBone(bone):
+    w, x, y, z = bone['orientation']
+    body = [packString(bone['name']),
+            struct.pack('<H3f4f', bone['id'], bone['position'][0], bone['position'][1],
+                        bone['position'][2], x, y, z, w)]
+    # scale is written only if it's not unit scale
+    scale = bone.get('scale', [1.0, 1.0, 1.0])
+    if list(scale) != [1.0, 1.0, 1.0]:
+        body.append(struct.pack('<3f', *scale))
+    return packChunk(SKELETON_BONE, b''.join(body))
+
+def packKeyFrame(keyFrame):
+    time, (w, x, y, z), translate, scale = keyFrame
+    body = struct.pack('<f4f3f', time, x, y, z, w, *translate)
+    if list(scale) != [1.0, 1.0, 1.0]:
+        body += struct.pack('<3f', *scale)
+    return packChunk(SKELETON_ANIMATION_TRACK_KEYFRAME, body)
+
+def packAnimation(animation):
+    body = [packString(animation['name']), struct.pack('<f', animation['length'])]
+    for boneHandle, keyFrames in sorted(animation['tracks'].items()):
+        track = [struct.pack('<H', boneHandle)]
+        track.extend([packKeyFrame(keyFrame) for keyFrame in keyFrames])
+        body.append(packChunk(SKELETON_ANIMATION_TRACK, b''.join(track)))
+    return packChunk(SKELETON_ANIMATION, b''.join(body))
+
+def writeSkeleton(filepath, ogreSkeleton):
+
+    # bones are stored in order of their handles
+    bones = sorted(ogreSkeleton['bones'], key=lambda bone: bone['id'])
+
+    body = [struct.pack('<H', SKELETON_HEADER) + packString(SKELETON_VERSION)]
+    body.extend([packBone(bone) for bone in bones])
+    for boneHandle, parentHandle in sorted(ogreSkeleton['parents'].items()):
+        body.append(packChunk(SKELETON_BONE_PARENT, struct.pack('<HH', boneHandle, parentHandle)))
+    body.extend([packAnimation(animation) for animation in ogreSkeleton.get('animations', [])])
+    for skeletonName, scale in ogreSkeleton.get('animationlinks', []):
+        body.append(packChunk(SKELETON_ANIMATION_LINK, packString(skeletonName) + struct.pack('<f', scale)))
+
+    fileWr = open(filepath, 'wb')
+    try:
+        fileWr.write(b''.join(body))
+    finally:
+        fileWr.close()
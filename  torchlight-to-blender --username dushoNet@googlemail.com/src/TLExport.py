@@ -21,12 +21,12 @@ This script imports/exports Torchlight Ogre models into/from Blender.
 
 Supported:<br>
     * import/export of basic meshes
-    * import of skeleton
+    * import/export of skeleton
     * import/export of vertex weights (ability to import characters and adjust rigs)
+    * import of skeletal animations
 
 Missing:<br>   
-    * skeletons (export)
-    * animations
+    * animation export
     * vertex color export
 
 Known issues:<br>
@@ -49,9 +49,18 @@ History:<br>
 from xml.dom import minidom
 import bpy
 from mathutils import Vector, Matrix
-#import math
+import math
 import os
 import shutil
+import itertools
+from xml.sax.saxutils import escape
+from array import array
+if __package__:
+    from . import TLBinary
+    from . import TLGeometry
+else:
+    import TLBinary
+    import TLGeometry
 
 SHOW_EXPORT_DUMPS = False
 SHOW_EXPORT_TRACE = False
@@ -74,16 +83,31 @@ class VertexInfo(object):
         self.boneWeights = boneWeights        
         
 
-    '''does not compare ogre_vidx (and position at the moment) [ no need to compare position ]'''
+    def key(self):
+        # exact vertex data, used for welding (equal keys -> same vertex)
+        return (self.px, self.py, self.pz, self.nx, self.ny, self.nz, self.u, self.v,
+                tuple(sorted(self.boneWeights.items())))
+
+    '''does not compare ogre_vidx'''
     def __eq__(self, o): 
-        if self.nx != o.nx or self.ny != o.ny or self.nz != o.nz: return False 
-        elif self.px != o.px or self.py != o.py or self.pz != o.pz: return False
-        elif self.u != o.u or self.v != o.v: return False
-        return True
+        return self.key() == o.key()
+    
+    def __hash__(self):
+        return hash(self.key())
     
-#    def __hash__(self):
-#        return hash(self.px) ^ hash(self.py) ^ hash(self.pz) ^ hash(self.nx) ^ hash(self.ny) ^ hash(self.nz)
-#        
+    def isClose(self, o, tolerances):
+        # same vertex within (position, normal, uv) tolerances
+        positionEpsilon, normalEpsilon, uvEpsilon = tolerances
+        return abs(self.px - o.px) <= positionEpsilon and \
+               abs(self.py - o.py) <= positionEpsilon and \
+               abs(self.pz - o.pz) <= positionEpsilon and \
+               abs(self.nx - o.nx) <= normalEpsilon and \
+               abs(self.ny - o.ny) <= normalEpsilon and \
+               abs(self.nz - o.nz) <= normalEpsilon and \
+               abs(self.u - o.u) <= uvEpsilon and \
+               abs(self.v - o.v) <= uvEpsilon and \
+               self.boneWeights == o.boneWeights
+        
 ########################################
 
 class Bone(object):
@@ -239,52 +263,34 @@ class Skeleton(object):
                 b.compute_rest()
                 self.roots.append( b )
 
-    def to_xml( self ):
-        from xml.dom.minidom import Document
-        
+    def to_xml( self, xWriter ):
+        # writes skeleton with XmlWriter
         _fps = float( bpy.context.scene.render.fps )
 
-        doc = Document()
-        root = doc.createElement('skeleton'); doc.appendChild( root )
-        bones = doc.createElement('bones'); root.appendChild( bones )
-        bh = doc.createElement('bonehierarchy'); root.appendChild( bh )
+        xWriter.startElement('skeleton')
+        xWriter.startElement('bones')
         for i,bone in enumerate(self.bones):
-            b = doc.createElement('bone')
-            b.setAttribute('name', bone.name)
-            b.setAttribute('id', str(bone.id) )
-            bones.appendChild( b )
             mat = bone.ogre_rest_matrix.copy()
-            if bone.parent:
-                bp = doc.createElement('boneparent')
-                bp.setAttribute('bone', bone.name)
-                bp.setAttribute('parent', bone.parent.name)
-                bh.appendChild( bp )
-
-            pos = doc.createElement( 'position' ); b.appendChild( pos )
+            xWriter.startElement('bone', ('id', bone.id), ('name', bone.name))
             x,y,z = mat.to_translation()
-            pos.setAttribute('x', '%6f' %x )
-            pos.setAttribute('y', '%6f' %y )
-            pos.setAttribute('z', '%6f' %z )
-            rot =  doc.createElement( 'rotation' )        # note "rotation", not "rotate"
-            b.appendChild( rot )
-
+            xWriter.element('position', ('x', '%6f' %x), ('y', '%6f' %y), ('z', '%6f' %z))
             q = mat.to_quaternion()
-            rot.setAttribute('angle', '%6f' %q.angle )
-            axis = doc.createElement('axis'); rot.appendChild( axis )
+            # note "rotation", not "rotate"
+            xWriter.startElement('rotation', ('angle', '%6f' %q.angle))
             x,y,z = q.axis
-            axis.setAttribute('x', '%6f' %x )
-            axis.setAttribute('y', '%6f' %y )
-            axis.setAttribute('z', '%6f' %z )
-
+            xWriter.element('axis', ('x', '%6f' %x), ('y', '%6f' %y), ('z', '%6f' %z))
+            xWriter.endElement()
             ## Ogre bones do not have initial scaling? ##
             ## NOTE: Ogre bones by default do not pass down their scaling in animation,
             ## so in blender all bones are like 'do-not-inherit-scaling'
-            if 0:
-                scale = doc.createElement('scale'); b.appendChild( scale )
-                x,y,z = swap( mat.to_scale() )
-                scale.setAttribute('x', str(x))
-                scale.setAttribute('y', str(y))
-                scale.setAttribute('z', str(z))
+            xWriter.endElement()
+        xWriter.endElement()
+        
+        xWriter.startElement('bonehierarchy')
+        for bone in self.bones:
+            if bone.parent:
+                xWriter.element('boneparent', ('bone', bone.name), ('parent', bone.parent.name))
+        xWriter.endElement()
 
 #        arm = self.arm
 #        if not arm.animation_data or (arm.animation_data and not arm.animation_data.nla_tracks):  # assume animated via constraints and use blender timeline.
@@ -423,7 +429,7 @@ class Skeleton(object):
 #                            scale.setAttribute('y', '%6f' %y)
 #                            scale.setAttribute('z', '%6f' %z)
 
-        return doc.toprettyxml(indent="    ")
+        xWriter.endElement()
 
  
 
@@ -437,9 +443,53 @@ def fileExist(filepath):
         print ("No file: ", filepath)
         return False
         
-def toFmtStr(number):
-    #return str("%0.7f" % number)
-    return str(round(number, 7))
+def roundFloats(values):
+    # values rounded to 7 digits for formatting with %s (whole column at once)
+    return [round(value, 7) for value in values]
+
+# vertices, faces, .. formatted and written at once
+XML_ROWS_PER_WRITE = 4096
+XML_ATTRIBUTE_ENTITIES = {'"': "&quot;", '\n': "&#10;"}
+
+class XmlWriter(object):
+    ''' Writes XML to file while it's created, indented as minidom's toprettyxml. '''
+
+    def __init__(self, fileout, indentation="    "):
+        self.file = fileout
+        self.indentation = indentation
+        self.tags = []
+        self.file.write('<?xml version="1.0" ?>\n')
+
+    def prefix(self):
+        return self.indentation * len(self.tags)
+
+    def attributes(self, attributes):
+        return ''.join([' %s="%s"' % (name, escape(str(value), XML_ATTRIBUTE_ENTITIES))
+                        for name, value in attributes])
+
+    def startElement(self, tag, *attributes):
+        self.file.write('%s<%s%s>\n' % (self.prefix(), tag, self.attributes(attributes)))
+        self.tags.append(tag)
+
+    def element(self, tag, *attributes):
+        # element without children
+        self.file.write('%s<%s%s/>\n' % (self.prefix(), tag, self.attributes(attributes)))
+
+    def endElement(self):
+        tag = self.tags.pop()
+        self.file.write('%s</%s>\n' % (self.prefix(), tag))
+
+    def rows(self, lines, rows):
+        # writes lines (indented relative to current element, with % formats)
+        # once for every row of values, XML_ROWS_PER_WRITE rows per write
+        prefix = self.prefix()
+        template = ''.join([prefix + line + '\n' for line in lines])
+        rows = iter(rows)
+        while True:
+            chunk = [template % row for row in itertools.islice(rows, XML_ROWS_PER_WRITE)]
+            if not chunk:
+                break
+            self.file.write(''.join(chunk))
 
 def indent(indent):
     """Indentation.
@@ -449,9 +499,9 @@ def indent(indent):
     """
     return "        "*indent 
 
-def xSaveGeometry(geometry, xDoc, xMesh, isShared):
+def xSaveGeometry(geometry, xWriter, isShared):
     # I guess positions (vertices) must be there always
-    vertices = geometry['positions']
+    vertexCount = geometry.vertexCount()
     
     if isShared:
         geometryType = "sharedgeometry"
@@ -459,158 +509,216 @@ def xSaveGeometry(geometry, xDoc, xMesh, isShared):
         geometryType = "geometry"
     
     isNormals = False
-    if 'normals' in geometry:    
+    if geometry.normals is not None:    
         isNormals = True
-        normals = geometry['normals']
         
     isTexCoordsSets = False
-    texCoordSets = geometry['texcoordsets']
-    if texCoordSets>0 and 'uvsets' in geometry:
+    texCoordSets = geometry.texCoordSets()
+    if texCoordSets>0:
         isTexCoordsSets = True
-        uvSets = geometry['uvsets']
     
-    xGeometry = xDoc.createElement(geometryType)
-    xGeometry.setAttribute("vertexcount", str(len(vertices)))
-    xMesh.appendChild(xGeometry)
+    xWriter.startElement(geometryType, ("vertexcount", vertexCount))
     
-    xVertexBuffer = xDoc.createElement("vertexbuffer")
-    xVertexBuffer.setAttribute("positions", "true")
+    attributes = [("positions", "true")]
     if isNormals:
-        xVertexBuffer.setAttribute("normals", "true")
+        attributes.append(("normals", "true"))
     if isTexCoordsSets:
-        xVertexBuffer.setAttribute("texture_coord_dimensions_0", "2")
-        xVertexBuffer.setAttribute("texture_coords", str(texCoordSets))
-    xGeometry.appendChild(xVertexBuffer)
-    
-    for i, vx in enumerate(vertices):
-        xVertex = xDoc.createElement("vertex")
-        xVertexBuffer.appendChild(xVertex)
-        xPosition = xDoc.createElement("position")
-        xPosition.setAttribute("x", toFmtStr(vx[0]))
-        xPosition.setAttribute("y", toFmtStr(vx[2]))
-        xPosition.setAttribute("z", toFmtStr(-vx[1]))
-        xVertex.appendChild(xPosition)
-        if isNormals:
-            xNormal = xDoc.createElement("normal")
-            xNormal.setAttribute("x", toFmtStr(normals[i][0]))
-            xNormal.setAttribute("y", toFmtStr(normals[i][2]))
-            xNormal.setAttribute("z", toFmtStr(-normals[i][1]))
-            xVertex.appendChild(xNormal)
-        if isTexCoordsSets:
-            xUVSet = xDoc.createElement("texcoord")
-            xUVSet.setAttribute("u", toFmtStr(uvSets[i][0][0])) # take only 1st set for now
-            xUVSet.setAttribute("v", toFmtStr(1.0 - uvSets[i][0][1]))            
-            xVertex.appendChild(xUVSet)
+        attributes.append(("texture_coord_dimensions_0", "2"))
+        attributes.append(("texture_coords", texCoordSets))
+    xWriter.startElement("vertexbuffer", *attributes)
+    
+    # blender -> Ogre axes, columns are formatted at once
+    positions = geometry.positions
+    lines = ['<vertex>',
+             '    <position x="%s" y="%s" z="%s"/>']
+    columns = [roundFloats(positions[0::3]),
+               roundFloats(positions[2::3]),
+               roundFloats([-y for y in positions[1::3]])]
+    if isNormals:
+        normals = geometry.normals
+        lines.append('    <normal x="%s" y="%s" z="%s"/>')
+        columns.extend([roundFloats(normals[0::3]),
+                        roundFloats(normals[2::3]),
+                        roundFloats([-y for y in normals[1::3]])])
+    if isTexCoordsSets:
+        uvs = geometry.uvsets[0] # take only 1st set for now
+        lines.append('    <texcoord u="%s" v="%s"/>')
+        columns.extend([roundFloats(uvs[0::2]),
+                        roundFloats([1.0 - v for v in uvs[1::2]])])
+    lines.append('</vertex>')
+    xWriter.rows(lines, zip(*columns))
+    
+    xWriter.endElement()
+    xWriter.endElement()
             
-def xSaveSubMeshes(meshData, xDoc, xMesh, hasSharedGeometry):
+def xSaveSubMeshes(meshData, xWriter, hasSharedGeometry):
             
-    xSubMeshes = xDoc.createElement("submeshes")
-    xMesh.appendChild(xSubMeshes)
+    xWriter.startElement("submeshes")
     
     for submesh in meshData['submeshes']:
                 
-        numVerts = len(submesh['geometry']['positions'])
+        if hasSharedGeometry:
+            numVerts = meshData['sharedgeometry'].vertexCount()
+        else:
+            numVerts = submesh['geometry'].vertexCount()
         
-        xSubMesh = xDoc.createElement("submesh")
-        xSubMesh.setAttribute("material", submesh['material'])
         if hasSharedGeometry:
-            xSubMesh.setAttribute("usesharedvertices", "true")
+            usesSharedVertices = "true"
         else:
-            xSubMesh.setAttribute("usesharedvertices", "false")
-        xSubMesh.setAttribute("use32bitindexes", str(bool(numVerts > 65535)))   
-        xSubMesh.setAttribute("operationtype", "triangle_list")  
-        xSubMeshes.appendChild(xSubMesh)
+            usesSharedVertices = "false"
+        xWriter.startElement("submesh",
+                             ("material", submesh['material']),
+                             ("usesharedvertices", usesSharedVertices),
+                             ("use32bitindexes", bool(numVerts > 65535)),
+                             ("operationtype", "triangle_list"))
         # write all faces
         if 'faces' in submesh:
             faces = submesh['faces']
-            xFaces = xDoc.createElement("faces")
-            xFaces.setAttribute("count", str(len(faces)))
-            xSubMesh.appendChild(xFaces)
-            for face in faces:
-                xFace = xDoc.createElement("face")
-                xFace.setAttribute("v1", str(face[0]))
-                xFace.setAttribute("v2", str(face[1]))
-                xFace.setAttribute("v3", str(face[2]))
-                xFaces.appendChild(xFace)
+            xWriter.startElement("faces", ("count", TLGeometry.faceCount(faces)))
+            xWriter.rows(['<face v1="%d" v2="%d" v3="%d"/>'],
+                         zip(faces[0::3], faces[1::3], faces[2::3]))
+            xWriter.endElement()
         # if there is geometry per sub mesh
         if 'geometry' in submesh:
             geometry = submesh['geometry']
-            xSaveGeometry(geometry, xDoc, xSubMesh, hasSharedGeometry)
-        # boneassignments
-        if 'skeleton' in meshData:
-            skelMeshData = meshData['skeleton']
-            xBoneAssignments = xDoc.createElement("boneassignments")
-            #print(submesh['geometry']['boneassignments'][0])
-            for vxIdx, vxBoneAsg in enumerate(submesh['geometry']['boneassignments']):
-                #print(submesh['geometry']['boneassignments'][vxIdx])
-                #print(vxBoneAsg)
-                for boneAndWeight in vxBoneAsg:
-                    #print(boneAndWeight)
-                    boneName = boneAndWeight[0]
-                    boneWeight = boneAndWeight[1]
-                    xVxBoneassignment = xDoc.createElement("vertexboneassignment")
-                    xVxBoneassignment.setAttribute("vertexindex", str(vxIdx))
-                    #print(boneName)
-                    boneNameToId = skelMeshData['boneIDs']
-                    #print(skelMeshData['boneIDs'])
-                    #print(boneNameToId[boneName])
-                    xVxBoneassignment.setAttribute("boneindex", str(skelMeshData['boneIDs'][boneName]))
-                    xVxBoneassignment.setAttribute("weight", '%6f' % boneWeight)
-                    xBoneAssignments.appendChild(xVxBoneassignment)
-            xSubMesh.appendChild(xBoneAssignments)
+            xSaveGeometry(geometry, xWriter, hasSharedGeometry)
+        # boneassignments (of shared geometry are in mesh)
+        if 'skeleton' in meshData and not hasSharedGeometry:
+            xWriter.startElement("boneassignments")
+            xWriter.rows(['<vertexboneassignment vertexindex="%d" boneindex="%d" weight="%6f"/>'],
+                         zip(*submesh['geometry'].boneassignments))
+            xWriter.endElement()
+        xWriter.endElement()
+    
+    xWriter.endElement()
             
 def xSaveSkeletonData(blenderMeshData, filepath):
     if 'skeleton' in blenderMeshData:
         skelData = blenderMeshData['skeleton']
         skel = skelData['instance']
-        data = skel.to_xml()
         name = skelData['name']
         #xmlfile = os.path.join(filepath, '%s.skeleton.xml' %name )
         nameOnly = os.path.splitext(filepath)[0] # removing .mesh
         xmlfile = nameOnly + ".skeleton.xml"
-        f = open( xmlfile, 'wb' )
-        f.write( bytes(data,'utf-8') )
+        f = open( xmlfile, 'w', encoding='utf-8' )
+        skel.to_xml(XmlWriter(f))
         f.close() 
     
     
+def binSaveSkeletonData(blenderMeshData, filepath):
+    if 'skeleton' in blenderMeshData:
+        skel = blenderMeshData['skeleton']['instance']
+        bones = []
+        parents = {}
+        for bone in skel.bones:
+            mat = bone.ogre_rest_matrix
+            q = mat.to_quaternion()
+            ogreBone = {}
+            ogreBone['name'] = bone.name
+            ogreBone['id'] = bone.id
+            ogreBone['position'] = list(mat.to_translation())
+            ogreBone['orientation'] = [q.w, q.x, q.y, q.z]
+            bones.append(ogreBone)
+            if bone.parent:
+                parents[bone.id] = bone.parent.id
+        
+        ogreSkeleton = {}
+        ogreSkeleton['bones'] = bones
+        ogreSkeleton['parents'] = parents
+        
+        nameOnly = os.path.splitext(filepath)[0] # removing .mesh
+        TLBinary.writeSkeleton(nameOnly + ".skeleton", ogreSkeleton)
+    
 def xSaveMeshData(meshData, filepath, export_and_link_skeleton):    
-    from xml.dom.minidom import Document
     
     hasSharedGeometry = False
     if 'sharedgeometry' in meshData:
         hasSharedGeometry = True
         
-    # Create the minidom document
-    xDoc = Document()
+    # elements are written to file as they are created
+    fileWr = open(filepath + ".xml", 'w', encoding='utf-8') 
+    xWriter = XmlWriter(fileWr, "    ") # 4 spaces
     
-    xMesh = xDoc.createElement("mesh")
-    xDoc.appendChild(xMesh)
+    xWriter.startElement("mesh")
     
     if hasSharedGeometry:
         geometry = meshData['sharedgeometry']
-        xSaveGeometry(geometry, xDoc, xMesh, hasSharedGeometry)
+        xSaveGeometry(geometry, xWriter, hasSharedGeometry)
     
-    xSaveSubMeshes(meshData, xDoc, xMesh, hasSharedGeometry)
+    xSaveSubMeshes(meshData, xWriter, hasSharedGeometry)
     
     #skeleton link only
     if 'skeleton' in meshData:
-        xSkeletonlink = xDoc.createElement("skeletonlink")
-        # default skeleton
-        linkSkeletonName = meshData['skeleton']['name']
-        if(export_and_link_skeleton):    
-            nameDotMeshDotXml = os.path.split(filepath)[1].lower()
-            nameDotMesh = os.path.splitext(nameDotMeshDotXml)[0]
-            linkSkeletonName = os.path.splitext(nameDotMesh)[0] 
-        #xSkeletonlink.setAttribute("name", meshData['skeleton']['name']+".skeleton")
-        xSkeletonlink.setAttribute("name", linkSkeletonName+".skeleton")
-        xMesh.appendChild(xSkeletonlink)
+        #xWriter.element("skeletonlink", ("name", meshData['skeleton']['name']+".skeleton"))
+        xWriter.element("skeletonlink", ("name", getSkeletonLinkName(meshData, filepath, export_and_link_skeleton)))
+        if hasSharedGeometry:
+            xWriter.startElement("boneassignments")
+            xWriter.rows(['<vertexboneassignment vertexindex="%d" boneindex="%d" weight="%6f"/>'],
+                         zip(*meshData['sharedgeometry'].boneassignments))
+            xWriter.endElement()
    
-    # Print our newly created XML    
-    fileWr = open(filepath + ".xml", 'w') 
-    fileWr.write(xDoc.toprettyxml(indent="    ")) # 4 spaces
-    #doc.writexml(fileWr, "  ")
+    xWriter.endElement()
     fileWr.close() 
     
+def getSkeletonLinkName(meshData, filepath, export_and_link_skeleton):
+    # default skeleton
+    linkSkeletonName = meshData['skeleton']['name']
+    if(export_and_link_skeleton):    
+        nameDotMeshDotXml = os.path.split(filepath)[1].lower()
+        nameDotMesh = os.path.splitext(nameDotMeshDotXml)[0]
+        linkSkeletonName = os.path.splitext(nameDotMesh)[0] 
+    return linkSkeletonName + ".skeleton"
+
+def binSaveGeometry(geometry):
+    # blender geometry -> Ogre binary vertex elements (with axis swap)
+    elements = []
+    elements.append((TLBinary.VES_POSITION, 0, 3,
+                     TLGeometry.blenderToOgreVectors(geometry.positions)))
+    
+    if geometry.normals is not None:
+        elements.append((TLBinary.VES_NORMAL, 0, 3,
+                         TLGeometry.blenderToOgreVectors(geometry.normals)))
+        
+    if geometry.texCoordSets()>0:
+        # take only 1st set for now
+        elements.append((TLBinary.VES_TEXTURE_COORDINATES, 0, 2,
+                         TLGeometry.flipUVs(geometry.uvsets[0])))
+    
+    ogreGeometry = {}
+    ogreGeometry['vertexcount'] = geometry.vertexCount()
+    ogreGeometry['elements'] = elements
+    return ogreGeometry
+
+def binSaveMeshData(meshData, filepath, export_and_link_skeleton, meshVersion):
+    
+    ogreMesh = {}
+    hasSharedGeometry = False
+    if 'sharedgeometry' in meshData:
+        hasSharedGeometry = True
+        geometry = meshData['sharedgeometry']
+        ogreMesh['sharedgeometry'] = binSaveGeometry(geometry)
+    
+    hasSkeleton = 'skeleton' in meshData
+    if hasSkeleton:
+        ogreMesh['skeletonlink'] = getSkeletonLinkName(meshData, filepath, export_and_link_skeleton)
+        if hasSharedGeometry and geometry.boneassignments is not None:
+            ogreMesh['boneassignments'] = geometry.boneassignments
+    
+    subMeshes = []
+    for submesh in meshData['submeshes']:
+        ogreSubMesh = {}
+        ogreSubMesh['material'] = submesh['material']
+        ogreSubMesh['usesharedvertices'] = hasSharedGeometry
+        ogreSubMesh['indices'] = submesh['faces']
+        if not hasSharedGeometry:
+            ogreSubMesh['geometry'] = binSaveGeometry(submesh['geometry'])
+            if hasSkeleton:
+                ogreSubMesh['boneassignments'] = submesh['geometry'].boneassignments
+        subMeshes.append(ogreSubMesh)
+    ogreMesh['submeshes'] = subMeshes
+    
+    TLBinary.writeMesh(filepath, ogreMesh, meshVersion)
+    
 def xSaveMaterialData(filepath, meshData, overwriteMaterialFlag, copyTextures):
     
     #print("filepath: %s" % filepath)
@@ -687,21 +795,65 @@ def xSaveMaterialData(filepath, meshData, overwriteMaterialFlag, copyTextures):
 
     
 
-def getVertexIndex(vertexInfo, vertexList):
-    
-    for vIdx, vert in enumerate(vertexList):
-        if vertexInfo == vert:
-            return vIdx
-    
-    #not present in list:
+def getVertexIndex(vertexInfo, vertexList, vertexIndex):
+    # vertexIndex {VertexInfo: index in vertexList} makes welding one
+    # dictionary lookup per face corner
+    vIdx = vertexIndex.get(vertexInfo)
+    if vIdx is None:
+        #not present in list:
+        vIdx = len(vertexList)
+        vertexList.append(vertexInfo)
+        vertexIndex[vertexInfo] = vIdx
+    return vIdx
+
+def getWeldedVertexIndex(vertexInfo, vertexList, weldGrid, weldTolerances):
+    # tolerance welding - positions are quantized to grid cells of position
+    # epsilon size, vertex is welded with first vertex close enough from its
+    # cell or neighbouring cells. weldGrid is {cell: [indices in vertexList]}
+    positionEpsilon = weldTolerances[0]
+    cx = int(math.floor(vertexInfo.px / positionEpsilon))
+    cy = int(math.floor(vertexInfo.py / positionEpsilon))
+    cz = int(math.floor(vertexInfo.pz / positionEpsilon))
+    for x in (cx-1, cx, cx+1):
+        for y in (cy-1, cy, cy+1):
+            for z in (cz-1, cz, cz+1):
+                for vIdx in weldGrid.get((x, y, z), ()):
+                    if vertexInfo.isClose(vertexList[vIdx], weldTolerances):
+                        return vIdx
+    vIdx = len(vertexList)
     vertexList.append(vertexInfo)
-    return len(vertexList)-1
+    weldGrid.setdefault((cx, cy, cz), []).append(vIdx)
+    return vIdx
 
-def bCollectMeshData(meshData, selectedObjects, applyModifiers):
+def bCollectMeshData(meshData, selectedObjects, applyModifiers, weldTolerances=None,
+                     sharedGeometry=False):
+    # weldTolerances - (position, normal, uv) epsilons for tolerance welding,
+    # None welds only exactly same vertices
+    # sharedGeometry - vertices of all objects are welded into one
+    # 'sharedgeometry', submeshes have only faces
+    
+    # bone IDs are used for bone assignments, vertex groups which are not
+    # bones are skipped
+    boneNameToId = {}
+    if 'skeleton' in meshData:
+        boneNameToId = meshData['skeleton']['boneIDs']
+    
+    # welding state, shared by all objects for shared geometry
+    vertexList = []        
+    vertexIndex = {}
+    weldGrid = {}
+    # exactly same vertices seen by tolerance welding, only for report
+    exactVertices = set()
+    sharedHasUVData = False
     
     subMeshesData = []
     for ob in selectedObjects:             
         subMeshData = {}        
+        # vertex group index -> bone ID, resolved once per group
+        groupToBoneId = {}
+        for vg in ob.vertex_groups:
+            if vg.name in boneNameToId:
+                groupToBoneId[vg.index] = int(boneNameToId[vg.name])
         #ob = bpy.types.Object ##
         materialName = ob.name
         if len(ob.data.materials)>0:
@@ -723,111 +875,81 @@ def bCollectMeshData(meshData, selectedObjects, applyModifiers):
             meshUV_textures = mesh.tessface_uv_textures 
             meshVertex_colors = mesh.tessface_vertex_colors
         
-        # first try to collect UV data
-        uvData = []
+        # vertex and face data are read into flat buffers at once
+        vertexCount = len(mesh.vertices)
+        coords = array('f', [0.0]) * (vertexCount*3)
+        mesh.vertices.foreach_get("co", coords)
+        vxNormals = array('f', [0.0]) * (vertexCount*3)
+        mesh.vertices.foreach_get("normal", vxNormals)
+        faceCount = len(meshFaces)
+        # 4 vertex indices per face, 4th is 0 for triangles
+        faceVertices = array('i', [0]) * (faceCount*4)
+        meshFaces.foreach_get("vertices_raw", faceVertices)
+        
+        # UVs of 4 corners per face, only 1st UV layer is exported
         hasUVData = False
         if meshUV_textures.active:
             hasUVData = True
-            #uvLayerTofaceUVdata = {}
-            for layer in meshUV_textures:
-                faceIdxToUVdata = {}
-                for fidx, uvface in enumerate(layer.data):               
-                    faceIdxToUVdata[fidx] = uvface.uv
-                #uvData[layer]=faceIdxToUVdata
-                uvData.append(faceIdxToUVdata)
-                      
-        vertexList = []        
-        newFaces = []
-                
-        for fidx, face in enumerate(meshFaces):
-            tris = []
-            tris.append( (face.vertices[0], face.vertices[1], face.vertices[2]) )
-            if(len(face.vertices)>=4):
-                tris.append( (face.vertices[0], face.vertices[2], face.vertices[3]) ) 
+            faceUVs = array('f', [0.0]) * (faceCount*8)
+            meshUV_textures[0].data.foreach_get("uv_raw", faceUVs)
+        
+        # bone weights per vertex (vertex groups are read once per vertex,
+        # not per face corner)
+        vertexBoneWeights = [{} for i in range(vertexCount)]
+        if groupToBoneId:
+            for vIdx, vxOb in enumerate(mesh.vertices):
+                boneWeights = vertexBoneWeights[vIdx]
+                for vxGroup in vxOb.groups:
+                    if vxGroup.weight > 0.01 and vxGroup.group in groupToBoneId:
+                        boneWeights[groupToBoneId[vxGroup.group]]=vxGroup.weight
+        
+        if not sharedGeometry:
+            vertexList = []        
+            vertexIndex = {}
+            weldGrid = {}
+            exactVertices = set()
+        newFaces = TLGeometry.newFaces()
+        
+        for fidx in range(faceCount):
+            faceVx = faceVertices[fidx*4:fidx*4+4]
+            # corners of triangles, quads are split to 2 triangles
+            if faceVx[3] == 0:
+                corners = (0, 1, 2)
+            else:
+                corners = (0, 1, 2, 0, 2, 3)
             if SHOW_EXPORT_TRACE_VX:
-                    print("_face: "+ str(fidx) + " indices [" + str(list(face.vertices))+ "]")
-            for tri in tris:
-                newFaceVx = []                        
-                for vertex in tri:
-                    vxOb = mesh.vertices[vertex]
-                    u = 0
-                    v = 0
-                    if hasUVData:
-                        uv = uvData[0][fidx][ list(tri).index(vertex) ] #take 1st layer only
-                        u = uv[0]
-                        v = uv[1]
-                    px = vxOb.co[0]
-                    py = vxOb.co[1]
-                    pz = vxOb.co[2]
-                    nx = vxOb.normal[0] 
-                    ny = vxOb.normal[1]
-                    nz = vxOb.normal[2]
-                    #vertex groups
-                    boneWeights = {}
-                    for vxGroup in vxOb.groups:
-                        if vxGroup.weight > 0.01:
-                            vg = ob.vertex_groups[ vxGroup.group ]
-                            boneWeights[vg.name]=vxGroup.weight
-                        
-                    if SHOW_EXPORT_TRACE_VX:
-                        print("_vx: "+ str(vertex)+ " co: "+ str([px,py,pz]) +
-                              " no: " + str([nx,ny,nz]) +
-                              " uv: " + str([u,v]))
-                    vert = VertexInfo(px,py,pz,nx,ny,nz,u,v,boneWeights)
-                    newVxIdx = getVertexIndex(vert, vertexList)
-                    newFaceVx.append(newVxIdx)
-                    if SHOW_EXPORT_TRACE_VX:
-                        print("Nvx: "+ str(newVxIdx)+ " co: "+ str([px,py,pz]) +
-                              " no: " + str([nx,ny,nz]) +
-                              " uv: " + str([u,v]))
-                newFaces.append(newFaceVx)
+                    print("_face: "+ str(fidx) + " indices [" + str(list(faceVx))+ "]")
+            for corner in corners:
+                vertex = faceVx[corner]
+                u = 0
+                v = 0
+                if hasUVData:
+                    u = faceUVs[fidx*8 + corner*2]
+                    v = faceUVs[fidx*8 + corner*2 + 1]
+                vert = VertexInfo(coords[vertex*3], coords[vertex*3+1], coords[vertex*3+2],
+                                  vxNormals[vertex*3], vxNormals[vertex*3+1], vxNormals[vertex*3+2],
+                                  u, v, vertexBoneWeights[vertex])
+                if weldTolerances is None:
+                    newVxIdx = getVertexIndex(vert, vertexList, vertexIndex)
+                else:
+                    exactVertices.add(vert)
+                    newVxIdx = getWeldedVertexIndex(vert, vertexList, weldGrid, weldTolerances)
+                newFaces.append(newVxIdx)
                 if SHOW_EXPORT_TRACE_VX:
-                    print("Nface: "+ str(fidx) + " indices [" + str(list(newFaceVx))+ "]")
+                    print("Nvx: "+ str(newVxIdx)+ " co: "+ str([vert.px,vert.py,vert.pz]) +
+                          " no: " + str([vert.nx,vert.ny,vert.nz]) +
+                          " uv: " + str([u,v]))
                   
-        # geometry
-        geometry = {}
-        #vertices = bpy.types.MeshVertices
-        #vertices = mesh.vertices
-        faces = [] 
-        normals = []
-        positions = []
-        uvTex = []
-        #vertex groups of object
-        boneAssignments = []
-        
-        faces = newFaces
-        
-        for vxInfo in vertexList:
-            positions.append([vxInfo.px, vxInfo.py, vxInfo.pz])
-            normals.append([vxInfo.nx, vxInfo.ny, vxInfo.nz])
-            uvTex.append([[vxInfo.u, vxInfo.v]])
-            
-            boneWeights = []
-            for boneW in vxInfo.boneWeights.keys():
-                boneWeights.append([boneW, vxInfo.boneWeights[boneW]])
-            boneAssignments.append(boneWeights)            
-            #print(boneWeights)
-        
-        if SHOW_EXPORT_TRACE_VX:
-            print("uvTex:")
-            print(uvTex)
-            print("boneAssignments:")
-            print(boneAssignments)
-        
-        geometry['positions'] = positions
-        geometry['normals'] = normals
-        geometry['texcoordsets'] = len(mesh.uv_textures)
-        if SHOW_EXPORT_TRACE:
-            print("texcoordsets: " + str(len(mesh.uv_textures)))
-        if hasUVData:
-            geometry['uvsets'] = uvTex
-                
-        #need bone name to bone ID dict
-        geometry['boneassignments'] = boneAssignments
+        if sharedGeometry:
+            sharedHasUVData = sharedHasUVData or hasUVData
+        else:
+            subMeshData['geometry'] = bCreateGeometryData(vertexList, hasUVData)
+            if weldTolerances is not None:
+                print("%s: %d vertices, %d after tolerance welding" %
+                      (ob.name, len(exactVertices), len(vertexList)))
         
         subMeshData['material'] = materialName
-        subMeshData['faces'] = faces
-        subMeshData['geometry'] = geometry
+        subMeshData['faces'] = newFaces
         subMeshesData.append(subMeshData)
         
         # if mesh was newly created with modifiers, remove the mesh
@@ -836,8 +958,50 @@ def bCollectMeshData(meshData, selectedObjects, applyModifiers):
         
     meshData['submeshes']=subMeshesData
     
+    if sharedGeometry:
+        meshData['sharedgeometry'] = bCreateGeometryData(vertexList, sharedHasUVData)
+        if weldTolerances is not None:
+            print("shared geometry: %d vertices, %d after tolerance welding" %
+                  (len(exactVertices), len(vertexList)))
+        else:
+            print("shared geometry: %d vertices" % len(vertexList))
+    
     return meshData
 
+def bCreateGeometryData(vertexList, hasUVData):
+    # Geometry from welded vertices
+    geometry = TLGeometry.Geometry()
+    normals = array('f')
+    positions = array('f')
+    uvTex = array('f')
+    #vertex groups of object (vertex index, bone ID, weight)
+    boneAssignments = TLBinary.newBoneAssignments()
+    
+    for vxIdx, vxInfo in enumerate(vertexList):
+        positions.extend((vxInfo.px, vxInfo.py, vxInfo.pz))
+        normals.extend((vxInfo.nx, vxInfo.ny, vxInfo.nz))
+        uvTex.extend((vxInfo.u, vxInfo.v))
+        
+        for boneId, boneWeight in vxInfo.boneWeights.items():
+            boneAssignments[0].append(vxIdx)
+            boneAssignments[1].append(boneId)
+            boneAssignments[2].append(boneWeight)
+    
+    if SHOW_EXPORT_TRACE_VX:
+        print("uvTex:")
+        print(uvTex)
+        print("boneAssignments:")
+        print(boneAssignments)
+    
+    geometry.positions = positions
+    geometry.normals = normals
+    if hasUVData:
+        # only 1st UV layer is exported
+        geometry.uvsets.append(uvTex)
+            
+    geometry.boneassignments = boneAssignments
+    return geometry
+
 def bCollectSkeletonData(blenderMeshData, selectedObjects):
     
     #need to collect bones 
@@ -899,14 +1063,16 @@ def bCollectMaterialData(blenderMeshData, selectedObjects):
     
     
 def SaveMesh(filepath, selectedObjects, ogreXMLconverter, applyModifiers,
-              overrideMaterialFlag, copyTextures, export_and_link_skeleton, keep_xml):
+              overrideMaterialFlag, copyTextures, export_and_link_skeleton, keep_xml,
+              meshVersion, weldTolerances=None, sharedGeometry=False):
     
     blenderMeshData = {}
     
     #skeleton
     bCollectSkeletonData(blenderMeshData, selectedObjects) 
     #mesh
-    bCollectMeshData(blenderMeshData, selectedObjects, applyModifiers)
+    bCollectMeshData(blenderMeshData, selectedObjects, applyModifiers, weldTolerances,
+                     sharedGeometry)
     #materials
     bCollectMaterialData(blenderMeshData, selectedObjects)
     
@@ -921,36 +1087,18 @@ def SaveMesh(filepath, selectedObjects, ogreXMLconverter, applyModifiers,
     
     #selObj = selectedObjects[0]
     
+    # .xml files are only for debugging, binary files are written directly
     if export_and_link_skeleton:
-        xSaveSkeletonData(blenderMeshData, filepath)  
+        if keep_xml:
+            xSaveSkeletonData(blenderMeshData, filepath)  
+        binSaveSkeletonData(blenderMeshData, filepath)
     
-    xSaveMeshData(blenderMeshData, filepath, export_and_link_skeleton)
+    if keep_xml:
+        xSaveMeshData(blenderMeshData, filepath, export_and_link_skeleton)
     
-    xSaveMaterialData(filepath, blenderMeshData, overrideMaterialFlag, copyTextures)
+    binSaveMeshData(blenderMeshData, filepath, export_and_link_skeleton, meshVersion)
     
-    XMLtoOGREConvert(blenderMeshData, filepath, ogreXMLconverter,
-                      export_and_link_skeleton, keep_xml)
-    
-def XMLtoOGREConvert(blenderMeshData, filepath, ogreXMLconverter,
-                     export_and_link_skeleton, keep_xml):
-        
-    if(ogreXMLconverter is not None):
-        # for mesh
-        # use Ogre XML converter  xml -> binary mesh
-        xmlFilepath = filepath + ".xml"
-        os.system('%s "%s"' % (ogreXMLconverter, xmlFilepath))        
-        # remove XML file
-        if keep_xml is False:
-            os.unlink("%s" % xmlFilepath)  
-        if 'skeleton' in blenderMeshData and export_and_link_skeleton:
-            # for skeleton
-            skelFile = os.path.splitext(filepath)[0] # removing .mesh
-            xmlFilepath = skelFile + ".skeleton.xml"
-            print(xmlFilepath)
-            os.system('%s "%s"' % (ogreXMLconverter, xmlFilepath))        
-            # remove XML file
-            if keep_xml is False:
-                os.unlink("%s" % xmlFilepath) 
+    xSaveMaterialData(filepath, blenderMeshData, overrideMaterialFlag, copyTextures)
 
 def save(operator, context, filepath,       
          ogreXMLconverter=None,
@@ -959,7 +1107,13 @@ def save(operator, context, filepath,
          apply_modifiers=True,
          overwrite_material=False,
          copy_textures=False,
-         export_and_link_skeleton=False,):
+         export_and_link_skeleton=False,
+         ogre_version='TL1',
+         weld_tolerance=False,
+         weld_position_epsilon=0.0001,
+         weld_normal_epsilon=0.001,
+         weld_uv_epsilon=0.0001,
+         shared_geometry=False,):
             
     global blender_version
     
@@ -991,8 +1145,17 @@ def save(operator, context, filepath,
         print("No objects selected for export.")
         return ('CANCELLED')
         
+    meshVersion = TLBinary.MESH_VERSION_TL1
+    if ogre_version == 'TL2':
+        meshVersion = TLBinary.MESH_VERSION_TL2
+        
+    weldTolerances = None
+    if weld_tolerance:
+        weldTolerances = (weld_position_epsilon, weld_normal_epsilon, weld_uv_epsilon)
+        
     SaveMesh(filepath, selectedObjects, ogreXMLconverter, apply_modifiers,
-              overwrite_material, copy_textures, export_and_link_skeleton, keep_xml)
+              overwrite_material, copy_textures, export_and_link_skeleton, keep_xml,
+              meshVersion, weldTolerances, shared_geometry)
     
     
     print("done.")
@@ -0,0 +1,90 @@
+"""
+Name: 'Compact geometry container for Torchlight'
+Blender: 2.59, 2.62, 2.63a
+
+Author: Dusho
+
+Vertex data shared by import and export are kept in flat typed arrays
+instead of lists of small Python lists (which cost 100+ bytes per float).
+Arrays support buffer protocol, so they can be handed to memoryview,
+foreach_set/foreach_get or file writers without copying.
+
+GEOMETRY (in Blender space):
+.positions - array('f'), x,y,z per vertex
+.normals - array('f'), x,y,z per vertex (or None)
+.vertexcolors - array('f'), r,g,b,a per vertex (or None)
+.uvsets - list of array('f'), u,v per vertex for every UV set
+.boneassignments - (vertexIndices, boneIndices, weights) parallel arrays, same
+                   as TLBinary BONEASSIGNMENTS (or None)
+Faces are stored as flat array('I') with 3 vertex indices per triangle.
+"""
+
+from array import array
+
+class Geometry(object):
+    def __init__(self):
+        self.positions = array('f')
+        self.normals = None
+        self.vertexcolors = None
+        self.uvsets = []
+        self.boneassignments = None
+
+    def __repr__(self):
+        return "Geometry(vertexcount=%d, normals=%s, vertexcolors=%s, texcoordsets=%d)" % \
+            (self.vertexCount(), self.normals is not None,
+             self.vertexcolors is not None, self.texCoordSets())
+
+    def vertexCount(self):
+        return len(self.positions) // 3
+
+    def texCoordSets(self):
+        return len(self.uvsets)
+
+    def position(self, i):
+        return self.positions[i*3:i*3+3]
+
+    def normal(self, i):
+        return self.normals[i*3:i*3+3]
+
+    def vertexColor(self, i):
+        return self.vertexcolors[i*4:i*4+4]
+
+    def uv(self, i, uvSet=0):
+        return self.uvsets[uvSet][i*2:i*2+2]
+
+def newFaces():
+    return array('I')
+
+def faceCount(faces):
+    return len(faces) // 3
+
+def gatherComponents(values, stride, indices, components=None):
+    # expands per-vertex attribute to per-index (e.g. per-loop) flat array
+    # with one indexed gather per component
+    if components is None:
+        components = stride
+    gathered = array('f', [0.0]) * (len(indices) * components)
+    for c in range(components):
+        column = values[c::stride]
+        gathered[c::components] = array('f', [column[i] for i in indices])
+    return gathered
+
+def ogreToBlenderVectors(values):
+    # flat x',y',z' (Ogre) -> flat x,y,z (Blender): x=x', y=-z', z=y'
+    vectors = array('f', values)
+    vectors[1::3] = array('f', [-z for z in values[2::3]])
+    vectors[2::3] = array('f', values[1::3])
+    return vectors
+
+def blenderToOgreVectors(values):
+    # flat x,y,z (Blender) -> flat x',y',z' (Ogre): x'=x, y'=z, z'=-y
+    vectors = array('f', values)
+    vectors[1::3] = array('f', values[2::3])
+    vectors[2::3] = array('f', [-y for y in values[1::3]])
+    return vectors
+
+def flipUVs(values):
+    # flat u,v <-> u',v': v = -v'+1 (same in both directions)
+    uvs = array('f', values)
+    uvs[1::2] = array('f', [1.0 - v for v in values[1::2]])
+    return uvs
@@ -21,12 +21,12 @@ This script imports/exports Torchlight Ogre models into/from Blender.
 
 Supported:<br>
     * import/export of basic meshes
-    * import of skeleton
+    * import/export of skeleton
     * import/export of vertex weights (ability to import characters and adjust rigs)
+    * import of skeletal animations
 
 Missing:<br>   
-    * skeletons (export)
-    * animations
+    * animation export
     * vertex color export
 
 Known issues:<br>
@@ -52,18 +52,16 @@ UVtex: u=u', v = -v'+1
 
 Inner data representation:
 MESHDATA:
-['sharedgeometry']: {}
-    ['positions'] - vectors with [x,y,z]
-    ['normals'] - vectors with [x,y,z]
-    ['vertexcolors'] - vectors with [r,g,b,a]
-    ['texcoordsets'] - integer (number of UV sets)
-    ['uvsets'] - vectors with [u,v] * number or UV sets for vertex [[u,v]][[u,v]]...
-    ['boneassignments']: {[boneName]} - for every bone name:
-        [[vertexNumber], [weight]], [[vertexNumber], [weight]],  ..
+['sharedgeometry']: TLGeometry.Geometry
+    .positions - flat array with x,y,z per vertex
+    .normals - flat array with x,y,z per vertex
+    .vertexcolors - flat array with r,g,b,a per vertex
+    .uvsets - list of flat arrays with u,v per vertex (one for every UV set)
+    .boneassignments - parallel arrays (vertexIndices, boneIndices, weights)
 ['submeshes'][idx]
         [material] - string (material name)
         [materialOrg] - original material name - for searching the in shared materials file
-        [faces] - vectors with faces [v1,v2,v3]
+        [faces] - flat array with v1,v2,v3 per face
         [geometry] - identical to 'sharedgeometry' data content   
 ['materials']
     [(matID)]: {}
@@ -76,16 +74,41 @@ MESHDATA:
         ['rotation'] - bone rotation [x,y,z,angle]
         ['parent'] - bone name of parent bone
         ['children'] - list with names if children ([child1, child2, ...])
+        ['length'] - length of bone (distance to only child, or default)
 ['boneIDs']: {[bone ID]:[bone Name]} - dictionary with ID to name
+['animations'] - list of ANIMATION
+ANIMATION:
+        ['name'] - animation name
+        ['length'] - length in seconds
+        ['file'] - binary .skeleton with keyframes (None for .xml skeleton)
+        ['offset'] - offset of animation chunk in ['file']
+        ['scale'] - scale of translations (from animation link)
+        ['tracks'] - {[boneName]: TRACK} (None until animation is loaded)
+TRACK (Ogre space, relative to bind pose of bone):
+        ['times'] - array with time (seconds) per keyframe
+        ['rotations'] - flat array with w,x,y,z per keyframe
+        ['translations'] - flat array with x,y,z per keyframe
+        ['scales'] - flat array with x,y,z per keyframe
     
 """
 
 #from Blender import *
 from xml.dom import minidom
+from xml.etree import ElementTree
+from array import array
 import bpy
 from mathutils import Vector, Matrix
 import math
 import os
+import collections
+if __package__:
+    from . import TLBinary
+    from . import TLGeometry
+    from . import TLMaterial
+else:
+    import TLBinary
+    import TLGeometry
+    import TLMaterial
 
 SHOW_IMPORT_DUMPS = False
 SHOW_IMPORT_TRACE = False
@@ -93,6 +116,19 @@ DEFAULT_KEEP_XML = False
 # default blender version of script
 blender_version = 259
 
+# session caches, datablocks are kept by name and checked before reuse
+# (they can be removed or renamed in the meantime)
+# {[texture path]: texture name}
+importedTextures = {}
+# {[material name]: [material names created for it]}
+importedMaterials = {}
+# animations are baked into actions only when activated
+# {[armature name]: {'skeleton':, 'boneIDs':, 'animations': {[name]: ANIMATION}}}
+animationIndex = {}
+# baked actions, least recently activated first {(armature, animation): action name}
+residentActions = collections.OrderedDict()
+MAX_RESIDENT_ACTIONS = 8
+
 #ogreXMLconverter=None
 
 # makes sure name doesn't exceeds blender naming limits
@@ -144,300 +180,276 @@ def xOpenFile(filename):
     xml_file.close()
     return output
 
-def xCollectFaceData(facedata):
-    faces = []
-    for face in facedata.childNodes:
-        if face.localName == 'face':
-            v1 = int(face.getAttributeNode('v1').value)
-            v2 = int(face.getAttributeNode('v2').value)
-            v3 = int(face.getAttributeNode('v3').value)
-            faces.append([v1,v2,v3])
+def xVertexBufferDecoders(vertexbuffer, geometry):
+    # creates empty arrays for all elements declared by vertexbuffer, adds
+    # them to geometry elements and returns decoders for vertex child tags:
+    # {tag: [(values, attribute names), ..]}, repeated tags (texcoord) are
+    # decoded in order
+    decoders = {}
+    def addElement(tag, semantic, index, attributes):
+        values = array('f')
+        geometry['elements'].append((semantic, index, len(attributes), values))
+        decoders.setdefault(tag, []).append((values, attributes))
     
-    return faces
+    # colours are stored in 'value' attribute as 'r g b a'
+    colour = ('r', 'g', 'b', 'a')
+    if vertexbuffer.get('positions') == 'true':
+        addElement('position', TLBinary.VES_POSITION, 0, ('x', 'y', 'z'))
+    if vertexbuffer.get('normals') == 'true':
+        addElement('normal', TLBinary.VES_NORMAL, 0, ('x', 'y', 'z'))
+    if vertexbuffer.get('colours_diffuse') == 'true':
+        addElement('colour_diffuse', TLBinary.VES_DIFFUSE, 0, colour)
+    if vertexbuffer.get('colours_specular') == 'true':
+        addElement('colour_specular', TLBinary.VES_SPECULAR, 0, colour)
+    if vertexbuffer.get('tangents') == 'true':
+        dimensions = int(vertexbuffer.get('tangent_dimensions', '3'))
+        addElement('tangent', TLBinary.VES_TANGENT, 0, ('x', 'y', 'z', 'w')[0:dimensions])
+    if vertexbuffer.get('binormals') == 'true':
+        addElement('binormal', TLBinary.VES_BINORMAL, 0, ('x', 'y', 'z'))
+    for i in range(int(vertexbuffer.get('texture_coords', 0))):
+        # dimensions are either '2' or 'float2'
+        dimensions = int(vertexbuffer.get('texture_coord_dimensions_%d' % i, '2')[-1])
+        addElement('texcoord', TLBinary.VES_TEXTURE_COORDINATES, i, ('u', 'v', 'w', 'x')[0:dimensions])
+    return decoders
+
+def xCollectVertex(vertex, decoders):
+    # decodes all declared elements of one vertex in single pass
+    counts = {}
+    for vp in vertex:
+        elements = decoders.get(vp.tag)
+        if elements is None:
+            continue
+        n = counts.get(vp.tag, 0)
+        counts[vp.tag] = n + 1
+        if n >= len(elements):
+            continue
+        values, attributes = elements[n]
+        if attributes[0] == 'r':
+            rgba = [float(c) for c in vp.get('value').split()]
+            values.extend((rgba + [1.0, 1.0, 1.0, 1.0])[0:4])
+        else:
+            values.extend([float(vp.get(a)) for a in attributes])
 
-def xCollectVertexData(data):
-    vertexdata = {}
-    vertices = []
-    normals = []
-    vertexcolors = []
+def xReadMesh(filename):
+    # streams .mesh.xml into the same structure as TLBinary.readMesh,
+    # every vertex, face and bone assignment element is freed right after
+    # it's decoded, so the whole document is never held in memory
+    ogreMesh = {}
+    ogreMesh['submeshes'] = []
+    ogreMesh['submeshnames'] = {}
+    ogreMesh['boneassignments'] = TLBinary.newBoneAssignments()
     
-    for vb in data.childNodes:
-        if vb.localName == 'vertexbuffer':
-            if vb.hasAttribute('positions'):
-                for vertex in vb.getElementsByTagName('vertex'):
-                    for vp in vertex.childNodes:
-                        if vp.localName == 'position':
-                            x = float(vp.getAttributeNode('x').value)
-                            y = -float(vp.getAttributeNode('z').value)
-                            z = float(vp.getAttributeNode('y').value)
-                            vertices.append([x,y,z])
-                vertexdata['positions'] = vertices            
-            
-            if vb.hasAttribute('normals'):
-                for vertex in vb.getElementsByTagName('vertex'):
-                    for vn in vertex.childNodes:
-                        if vn.localName == 'normal':
-                            x = float(vn.getAttributeNode('x').value)
-                            y = -float(vn.getAttributeNode('z').value)
-                            z = float(vn.getAttributeNode('y').value)
-                            normals.append([x,y,z])
-                vertexdata['normals'] = normals                
-            
-            if vb.hasAttribute('colours_diffuse'):
-                for vertex in vb.getElementsByTagName('vertex'):
-                    for vcd in vertex.childNodes:
-                        if vcd.localName == 'colour_diffuse':
-                            rgba = vcd.getAttributeNode('value').value
-                            r = float(rgba.split()[0])
-                            g = float(rgba.split()[1])
-                            b = float(rgba.split()[2])
-                            a = float(rgba.split()[3])
-                            vertexcolors.append([r,g,b,a])
-                vertexdata['vertexcolors'] = vertexcolors
-            
-            if vb.hasAttribute('texture_coord_dimensions_0'):
-                texcosets = int(vb.getAttributeNode('texture_coords').value)
-                vertexdata['texcoordsets'] = texcosets
-                uvcoordset = []
-                for vertex in vb.getElementsByTagName('vertex'):
-                    uvcoords = []
-                    for vt in vertex.childNodes:
-                        if vt.localName == 'texcoord':
-                            u = float(vt.getAttributeNode('u').value)
-                            v = -float(vt.getAttributeNode('v').value)+1.0
-                            uvcoords.append([u,v])
-                                
-                    if len(uvcoords) > 0:
-                        uvcoordset.append(uvcoords)
-                vertexdata['uvsets'] = uvcoordset                
-                        
-    return vertexdata
-
-def xCollectMeshData(meshData, xmldoc, meshname, dirname):
-    #global has_skeleton
-    #meshData = {}
-    faceslist = []
-    subMeshData = []
-    allObjs = []
-    isSharedGeometry = False
-    sharedGeom = []
+    subMesh = None
+    geometry = None
+    container = None
+    decoders = None
+    facesCount = 0
+    # faces are collected only inside <submesh><faces>, LOD face lists
+    # (<lodfacelist>) have <face> elements too
+    inFaces = False
+    try:
+        for event, elem in ElementTree.iterparse(filename, events=('start', 'end')):
+            tag = elem.tag
+            if event == 'start':
+                if tag == 'sharedgeometry' or tag == 'geometry':
+                    geometry = {}
+                    geometry['vertexcount'] = int(elem.get('vertexcount', 0))
+                    geometry['elements'] = []
+                    if subMesh is None:
+                        ogreMesh['sharedgeometry'] = geometry
+                    else:
+                        subMesh['geometry'] = geometry
+                elif tag == 'vertexbuffer':
+                    container = elem
+                    decoders = xVertexBufferDecoders(elem, geometry)
+                elif tag == 'submesh':
+                    subMesh = {}
+                    subMesh['material'] = elem.get('material')
+                    subMesh['usesharedvertices'] = (elem.get('usesharedvertices') == 'true')
+                    subMesh['operationtype'] = TLBinary.OT_TRIANGLE_LIST
+                    subMesh['indices'] = array('I')
+                    subMesh['boneassignments'] = TLBinary.newBoneAssignments()
+                    ogreMesh['submeshes'].append(subMesh)
+                elif tag == 'faces' and subMesh is not None:
+                    container = elem
+                    inFaces = True
+                    facesCount = int(elem.get('count', 0))
+                elif tag == 'boneassignments':
+                    container = elem
+                    if subMesh is None:
+                        boneAssignments = ogreMesh['boneassignments']
+                    else:
+                        boneAssignments = subMesh['boneassignments']
+                elif tag == 'skeletonlink':
+                    ogreMesh['skeletonlink'] = elem.get('name')
+                elif tag == 'submeshname':
+                    ogreMesh['submeshnames'][int(elem.get('index'))] = elem.get('name')
+            else:
+                if tag == 'vertex':
+                    xCollectVertex(elem, decoders)
+                    container.clear()
+                elif tag == 'face':
+                    if inFaces:
+                        subMesh['indices'].extend((int(elem.get('v1')), int(elem.get('v2')), int(elem.get('v3'))))
+                        container.clear()
+                    else:
+                        elem.clear()
+                elif tag == 'vertexboneassignment':
+                    boneAssignments[0].append(int(elem.get('vertexindex')))
+                    boneAssignments[1].append(int(elem.get('boneindex')))
+                    boneAssignments[2].append(float(elem.get('weight')))
+                    container.clear()
+                elif tag == 'faces' and inFaces:
+                    inFaces = False
+                    if len(subMesh['indices']) != facesCount*3:
+                        print ("FacesCount doesn't match!")
+                elif tag == 'submesh':
+                    subMesh = None
+                    elem.clear()
+                elif tag == 'sharedgeometry' or tag == 'geometry':
+                    for semantic, index, comps, values in geometry['elements']:
+                        if len(values) != geometry['vertexcount']*comps:
+                            print ("VertexCount doesn't match!")
+                    geometry = None
+    except (IOError, ElementTree.ParseError, ValueError) as e:
+        print ("File not valid! (%s)" % e)
+        return None
     
-    # collect shared geometry    
-    if(len(xmldoc.getElementsByTagName('sharedgeometry')) > 0):
-        isSharedGeometry = True
-        for subnodes in xmldoc.getElementsByTagName('sharedgeometry'):
-            meshData['sharedgeometry'] = xCollectVertexData(subnodes)
-        for subnodes in xmldoc.getElementsByTagName('boneassignments'): # TODO: will store just last?
-            meshData['sharedgeometry']['boneassignments'] = xCollectBoneAssignments(meshData, subnodes)
-            
-    # collect submeshes data       
-    for submeshes in xmldoc.getElementsByTagName('submeshes'):
-        for submesh in submeshes.childNodes:
-            if submesh.localName == 'submesh':
-                materialOrg = str(submesh.getAttributeNode('material').value)
-                # to avoid Blender naming limit problems
-                material = GetValidBlenderName(materialOrg)
-                sm = {}
-                sm['material']=material
-                sm['materialOrg']=materialOrg
-                for subnodes in submesh.childNodes:
-                    if subnodes.localName == 'faces':
-                        facescount = int(subnodes.getAttributeNode('count').value)                        
-                        sm['faces']=xCollectFaceData(subnodes)
-                    
-                        if len(xCollectFaceData(subnodes)) != facescount:
-                            print ("FacesCount doesn't match!")
-                            break 
-                    
-                    if (subnodes.localName == 'geometry'):
-                        vertexcount = int(subnodes.getAttributeNode('vertexcount').value)
-                        sm['geometry']=xCollectVertexData(subnodes)
-                                                                   
-                    if subnodes.localName == 'boneassignments' and isSharedGeometry==False:
-                        sm['geometry']['boneassignments']=xCollectBoneAssignments(meshData, subnodes)
-#                       
-                        
-                subMeshData.append(sm)
-                
-    meshData['submeshes']=subMeshData
-            
-    return meshData
+    return ogreMesh
+
+def ogreCollectMaterial(material, materials):
+    # material data used by Blender from first technique of parsed material
+    matDict = {}
+    # textures are relative to .material file of material which defines
+    # them (inherited material can be in other folder)
+    folder = os.path.dirname(TLMaterial.getTechniquesOwner(material, materials)['file'])
+    for ogrePass in TLMaterial.getPasses(material, materials):
+        for colour in ('ambient', 'diffuse', 'specular', 'emissive'):
+            value = TLMaterial.getColour(ogrePass['properties'], colour)
+            if value is not None and colour not in matDict:
+                matDict[colour] = value
+        # texture
+        for textureUnit in ogrePass.get('textureunits', []):
+            texture = textureUnit['properties'].get('texture', [])
+            if len(texture) == 0 or 'texture' in matDict:
+                continue
+            imageName = texture[0]
+            file = os.path.join(folder, imageName)                        
+            if(not os.path.isfile(file)):
+                # just force to use .dds if there isn't file specified in material file
+                file = os.path.join(folder, os.path.splitext(imageName)[0] + ".dds")
+                if(os.path.isfile(file)):
+                    matDict['texture'] = file
+                    matDict['imageNameOnly'] = imageName
+                else:
+                    print("WARNING: Referenced texture '%s' not found" % file)
+            else:
+                matDict['texture'] = file
+                matDict['imageNameOnly'] = imageName
+    return matDict
 
-def xCollectMaterialData(meshData, materialFiles, folder):
+def xCollectMaterialData(meshData, materialFile, mediaRoot):
     
-    data = None
-    if len(materialFiles)==1:
-        materialFile = materialFiles[0]    
+    materials = {}
+    # materials from .material file of the mesh
+    if materialFile is not None:
         try:
-            filein = open(materialFile)
-        except:
+            materials.update(TLMaterial.readMaterialFile(materialFile))
+        except (IOError, OSError):
             print ("WARNING: Material: File", materialFile, "not found!")
-            return 'None' 
-        data = filein.readlines()
-        filein.close()
-    else:        
-        #we have multiple material files, so check them for required materials
-        #pick one material from meshData
-        if(len(meshData['submeshes'])>0):
-            # take only first material
-            firstMaterial = meshData['submeshes'][0]['materialOrg']
-                
-            materialFound = False
-            for matFile in materialFiles:
-                try:
-                    filein = open(matFile)
-                except:
-                    print ("WARNING: Material: File", matFile, "not found!")
-                    return 'None' 
-                data = filein.readlines()
-                filein.close()
-                # try to find material name in file
-                materialFound = False
-                for line in data:
-                    if firstMaterial in line:
-                        materialFound = True
-                        break
-                
-                if materialFound:
-                    print("Material '%s' found in '%s'" % (firstMaterial, matFile))
-                    break
-            # material is not found at all
-            if not materialFound:
-                data = None
+    
+    # materials of other submeshes (and inherited materials defined
+    # elsewhere) are looked up in index of media tree
+    missing = [submesh['materialOrg'] for submesh in meshData['submeshes']
+               if submesh['materialOrg'] not in materials]
+    missing.extend([material['parent'] for material in materials.values()
+                    if material['parent'] is not None and material['parent'] not in materials])
+    if len(missing)>0:
+        materialIndex = TLMaterial.loadMaterialIndex(mediaRoot)
+        for name in missing:
+            material = TLMaterial.findMaterial(name, materialIndex, materials)
+            if material is not None:
+                print("Material '%s' found in '%s'" % (name, material['file']))
+            else:
+                print("WARNING: Material '%s' not found" % name)
            
-    MaterialDic = {}
     allMaterials = {}
-    
-    #no material data, so just return     
-    if data!=None:
-        count = 0
-        for line in data:
-            if "material" in line:
-                MaterialName = line.split()[1]
-                # to avoid Blender naming limit problems
-                MaterialName = GetValidBlenderName(MaterialName)
-                MaterialDic[MaterialName] = []
-                count = 0
-            if "{" in line:
-                count += 1
-            if  count > 0:
-                MaterialDic[MaterialName].append(line)
-            if "}" in line:
-                count -= 1
-        
-        #print(MaterialDic)
-        for Material in MaterialDic.keys():
-            count = 0
-            matDict = {}
-            allMaterials[Material] = matDict   
-            if SHOW_IMPORT_TRACE:     
-                print ("Materialname: ", Material)
-            for line in MaterialDic[Material]:
-                #if "texture_unit" in line:
-                    #allMaterials[Material] = ""
-                    #count = 0
-                if "{" in line:
-                    count+=1
-                # texture
-                if (count > 0) and ("texture " in line) and ('texture' not in matDict):
-                    imageName = (line.split()[1])
-                    file = os.path.join(folder, imageName)                        
-                    if(not os.path.isfile(file)):
-                        # just force to use .dds if there isn't file specified in material file
-                        file = os.path.join(folder, os.path.splitext((line.split()[1]))[0] + ".dds")
-                        if(os.path.isfile(file)):
-                            matDict['texture'] = file
-                            matDict['imageNameOnly'] = imageName
-                        else:
-                            print("WARNING: Referenced texture '%s' not found" % file)
-                    else:
-                        matDict['texture'] = file
-                        matDict['imageNameOnly'] = imageName
-                # ambient color
-                if(count>0) and ("ambient" in line):
-                    lineSplit = line.split()
-                    if len(lineSplit)>=4:
-                        r=float(lineSplit[1])
-                        g=float(lineSplit[2])
-                        b=float(lineSplit[3])
-                        matDict['ambient'] = [r,g,b]
-                # diffuse color        
-                if(count>0) and ("diffuse" in line):
-                    lineSplit = line.split()
-                    if len(lineSplit)>=4:
-                        r=float(lineSplit[1])
-                        g=float(lineSplit[2])
-                        b=float(lineSplit[3])
-                        matDict['diffuse'] = [r,g,b]
-                        
-                # specular color        
-                if(count>0) and ("specular" in line):
-                    lineSplit = line.split()
-                    if len(lineSplit)>=4:
-                        r=float(lineSplit[1])
-                        g=float(lineSplit[2])
-                        b=float(lineSplit[3])
-                        matDict['specular'] = [r,g,b]
-                        
-                # emissive color        
-                if(count>0) and ("emissive" in line):
-                    lineSplit = line.split()
-                    if len(lineSplit)>=4:
-                        r=float(lineSplit[1])
-                        g=float(lineSplit[2])
-                        b=float(lineSplit[3])
-                        matDict['emissive'] = [r,g,b]
-                                        
-                if "}" in line:
-                    count-=1
+    for name, material in materials.items():
+        if SHOW_IMPORT_TRACE:     
+            print ("Materialname: ", name)
+        # to avoid Blender naming limit problems
+        allMaterials[GetValidBlenderName(name)] = \
+            ogreCollectMaterial(material, materials)
     
     # store it into meshData
     meshData['materials']= allMaterials
     if SHOW_IMPORT_TRACE:
         print("allMaterials: %s" % allMaterials)
  
-def xCollectBoneAssignments(meshData, xmldoc):
-    boneIDtoName = meshData['boneIDs']
-    
-    VertexGroups = {}
-    for vg in xmldoc.childNodes:
-        if vg.localName == 'vertexboneassignment':
-            VG = str(vg.getAttributeNode('boneindex').value)
-            if VG in boneIDtoName.keys():
-                VGNew = boneIDtoName[VG]
-            else:
-                VGNew = VG
-            if VGNew not in VertexGroups.keys():
-                VertexGroups[VGNew] = []
-                
-    for vg in xmldoc.childNodes:
-        if vg.localName == 'vertexboneassignment':
-            
-            VG = str(vg.getAttributeNode('boneindex').value)
-            if VG in boneIDtoName.keys():
-                VGNew = boneIDtoName[VG]
-            else:
-                VGNew = VG
-            verti = int(vg.getAttributeNode('vertexindex').value)
-            weight = float(vg.getAttributeNode('weight').value)
-            #print("bone=%s, vert=%s, weight=%s" % (VGNew,verti,weight))
-            VertexGroups[VGNew].append([verti,weight])
-            
-    return VertexGroups
-    
-
-def xGetSkeletonLink(xmldoc, folder):
+def ogreGetSkeletonLink(ogreMesh, folder):
     skeletonFile = "None"
-    if(len(xmldoc.getElementsByTagName("skeletonlink")) > 0):
-        # get the skeleton link of the mesh
-        skeleton_link = xmldoc.getElementsByTagName("skeletonlink")[0]
-        skeletonFile = os.path.join(folder, skeleton_link.getAttribute("name"))
+    if 'skeletonlink' in ogreMesh:
+        skeletonFile = os.path.join(folder, ogreMesh['skeletonlink'])
         # check for existence of skeleton file
         if fileExist(skeletonFile)==False:
             skeletonFile = "None"
-        
+
     return skeletonFile
 
+def ogreCollectVertexData(ogreGeometry):
+    geometry = TLGeometry.Geometry()
+    texcoords = []
+
+    for semantic, index, comps, values in ogreGeometry['elements']:
+        if semantic == TLBinary.VES_POSITION:
+            geometry.positions = TLGeometry.ogreToBlenderVectors(values)
+        elif semantic == TLBinary.VES_NORMAL:
+            geometry.normals = TLGeometry.ogreToBlenderVectors(values)
+        elif semantic == TLBinary.VES_DIFFUSE:
+            geometry.vertexcolors = array('f', values)
+        elif semantic == TLBinary.VES_TEXTURE_COORDINATES:
+            texcoords.append((index, comps, values))
+
+    texcoords.sort(key=lambda t: t[0])
+    for index, comps, values in texcoords:
+        uvs = array('f', [0.0]) * (ogreGeometry['vertexcount'] * 2)
+        uvs[0::2] = array('f', values[0::comps])
+        if comps > 1:
+            uvs[1::2] = array('f', values[1::comps])
+        geometry.uvsets.append(TLGeometry.flipUVs(uvs))
+
+    return geometry
+
+def ogreCollectMeshData(meshData, ogreMesh):
+    # fills meshData from mesh read by TLBinary.readMesh or xReadMesh
+    subMeshData = []
+    isSharedGeometry = False
+
+    if 'sharedgeometry' in ogreMesh:
+        isSharedGeometry = True
+        meshData['sharedgeometry'] = ogreCollectVertexData(ogreMesh['sharedgeometry'])
+        if len(ogreMesh['boneassignments'][0]) > 0:
+            meshData['sharedgeometry'].boneassignments = ogreMesh['boneassignments']
+
+    for submesh in ogreMesh['submeshes']:
+        materialOrg = submesh['material']
+        # to avoid Blender naming limit problems
+        material = GetValidBlenderName(materialOrg)
+        sm = {}
+        sm['material']=material
+        sm['materialOrg']=materialOrg
+        indices = submesh['indices']
+        sm['faces'] = array('I', indices[0:TLGeometry.faceCount(indices)*3])
+        if 'geometry' in submesh:
+            sm['geometry'] = ogreCollectVertexData(submesh['geometry'])
+            if len(submesh['boneassignments'][0]) > 0 and isSharedGeometry==False:
+                sm['geometry'].boneassignments = submesh['boneassignments']
+        subMeshData.append(sm)
+
+    meshData['submeshes']=subMeshData
+
+    return meshData
+
 #def xCollectBoneData(meshData, xDoc, name, folder):
 def xCollectBoneData(meshData, xDoc):
     OGRE_Bones = {}
@@ -478,12 +490,158 @@ def xCollectBoneData(meshData, xDoc):
                 Parent = str(boneparent.getAttributeNode('parent').value)
                 OGRE_Bones[Bone]['parent'] = Parent
     
+    calcBoneData(OGRE_Bones)
+
+    return OGRE_Bones
+
+def binCollectBoneData(meshData, ogreSkeleton):
+    # same as xCollectBoneData, but from binary .skeleton
+    OGRE_Bones = {}
+    BoneIDToName = {}
+    meshData['skeleton'] = OGRE_Bones
+    meshData['boneIDs']= BoneIDToName
+
+    for bone in ogreSkeleton['bones']:
+        OGRE_Bone = {}
+        boneName = bone['name']
+        boneID = bone['id']
+        OGRE_Bone['name'] = boneName
+        OGRE_Bone['id'] = boneID
+        BoneIDToName[str(boneID)] = boneName
+        OGRE_Bone['position'] = bone['position']
+        OGRE_Bone['rotation'] = quaternionToAxisAngle(bone['orientation'])
+        OGRE_Bones[boneName] = OGRE_Bone
+
+    for boneID, parentID in ogreSkeleton['parents'].items():
+        Bone = BoneIDToName[str(boneID)]
+        Parent = BoneIDToName[str(parentID)]
+        OGRE_Bones[Bone]['parent'] = Parent
+
+    calcBoneData(OGRE_Bones)
+
+    return OGRE_Bones
+
+def newAnimationTrack():
+    track = {}
+    track['times'] = array('f')
+    track['rotations'] = array('f')
+    track['translations'] = array('f')
+    track['scales'] = array('f')
+    return track
+
+def xReadVector(node):
+    return [float(node.getAttribute('x')), float(node.getAttribute('y')), float(node.getAttribute('z'))]
+
+def xCollectAnimationData(meshData, xDoc):
+    # keyframes of all animations in .skeleton.xml, one TRACK per bone
+    # (document is parsed already, so they are kept), returns animation links
+    animations = meshData.setdefault('animations', [])
+
+    for xAnimations in xDoc.getElementsByTagName('animations'):
+        for xAnimation in xAnimations.getElementsByTagName('animation'):
+            animation = {}
+            animation['name'] = str(xAnimation.getAttribute('name'))
+            animation['length'] = float(xAnimation.getAttribute('length'))
+            animation['file'] = None
+            animation['offset'] = 0
+            animation['scale'] = 1.0
+            tracks = {}
+            animation['tracks'] = tracks
+            for xTrack in xAnimation.getElementsByTagName('track'):
+                track = newAnimationTrack()
+                for xKeyFrame in xTrack.getElementsByTagName('keyframe'):
+                    translate = [0.0, 0.0, 0.0]
+                    rotate = [1.0, 0.0, 0.0, 0.0]
+                    scale = [1.0, 1.0, 1.0]
+                    for k in xKeyFrame.childNodes:
+                        if k.localName == 'translate':
+                            translate = xReadVector(k)
+                        elif k.localName == 'rotate':
+                            angle = float(k.getAttribute('angle'))
+                            for axis in k.getElementsByTagName('axis'):
+                                rotate = axisAngleToQuaternion(xReadVector(axis) + [angle])
+                        elif k.localName == 'scale':
+                            scale = xReadVector(k)
+                    track['times'].append(float(xKeyFrame.getAttribute('time')))
+                    track['rotations'].extend(rotate)
+                    track['translations'].extend(translate)
+                    track['scales'].extend(scale)
+                tracks[str(xTrack.getAttribute('bone'))] = track
+            animations.append(animation)
+
+    links = []
+    for xLink in xDoc.getElementsByTagName('animationlink'):
+        links.append((str(xLink.getAttribute('skeletonName')), float(xLink.getAttribute('scale') or 1.0)))
+    return links
+
+def binCollectAnimationData(meshData, ogreSkeleton, skeletonFile, scale=1.0):
+    # only names and lengths of animations (keyframes are read by
+    # binLoadAnimation), returns animation links
+    animations = meshData.setdefault('animations', [])
+    for ogreAnimation in ogreSkeleton['animations']:
+        animation = {}
+        animation['name'] = ogreAnimation['name']
+        animation['length'] = ogreAnimation['length']
+        animation['file'] = skeletonFile
+        animation['offset'] = ogreAnimation['offset']
+        animation['scale'] = scale
+        animation['tracks'] = None
+        animations.append(animation)
+    return ogreSkeleton['animationlinks']
+
+def binCollectAnimationLinks(meshData, links, folder):
+    # animations of linked skeletons (bone handles are the same as ours)
+    for skeletonName, scale in links:
+        linkFile = os.path.join(folder, os.path.basename(skeletonName))
+        try:
+            ogreSkeleton = TLBinary.readSkeleton(linkFile, loadAnimations=False)
+        except (IOError, TLBinary.OgreBinaryError) as e:
+            print("WARNING: Can't read linked skeleton %s (%s)" % (skeletonName, e))
+            continue
+        binCollectAnimationData(meshData, ogreSkeleton, linkFile, scale)
+
+def binLoadAnimation(animation, boneIDs):
+    # reads keyframes of animation into TRACKs, returns {[boneName]: TRACK}
+    ogreAnimation = TLBinary.readAnimationAt(animation['file'], animation['offset'])
+    tracks = {}
+    for boneHandle, keyFrames in ogreAnimation['tracks'].items():
+        if str(boneHandle) not in boneIDs:
+            continue
+        track = newAnimationTrack()
+        for time, rotate, translate, scale in keyFrames:
+            track['times'].append(time)
+            track['rotations'].extend(rotate)
+            track['translations'].extend(translate)
+            track['scales'].extend(scale)
+        if animation['scale'] != 1.0:
+            track['translations'] = array('f', [v*animation['scale'] for v in track['translations']])
+        tracks[boneIDs[str(boneHandle)]] = track
+    return tracks
+
+def axisAngleToQuaternion(rot):
+    # [x,y,z,angle] -> [w,x,y,z]
+    length = math.sqrt(rot[0]**2 + rot[1]**2 + rot[2]**2)
+    if length == 0.0:
+        return [1.0, 0.0, 0.0, 0.0]
+    s = math.sin(rot[3]/2.0)/length
+    return [math.cos(rot[3]/2.0), rot[0]*s, rot[1]*s, rot[2]*s]
+
+def quaternionToAxisAngle(quat):
+    # same as Ogre's Quaternion::ToAngleAxis, returns [x,y,z,angle]
+    w, x, y, z = quat
+    sqrLength = x*x + y*y + z*z
+    if sqrLength > 0.0:
+        angle = 2.0*math.acos(max(-1.0, min(1.0, w)))
+        invLength = 1.0/math.sqrt(sqrLength)
+        return [x*invLength, y*invLength, z*invLength, angle]
+    return [1.0, 0.0, 0.0, 0.0]
+
+def calcBoneData(OGRE_Bones):
     #update Ogre bones with list of children
     calcBoneChildren(OGRE_Bones)
-       
-    #helper bones
-    calcHelperBones(OGRE_Bones)
-    calcZeroBones(OGRE_Bones)
+    
+    #update Ogre bones with lengths (tails)
+    calcBoneLengths(OGRE_Bones)
     
     #update Ogre bones with head positions
     calcBoneHeadPositions(OGRE_Bones)
@@ -491,168 +649,101 @@ def xCollectBoneData(meshData, xDoc):
     #update Ogre bones with rotation matrices
     calcBoneRotations(OGRE_Bones)
 
-    return OGRE_Bones
 def calcBoneChildren(BonesData):
+    # parent -> children adjacency in one pass
     for bone in BonesData.keys():
-        childlist = []
-        for key in BonesData.keys():
-            if 'parent' in BonesData[key]:
-                parent = BonesData[key]['parent']
-                if parent == bone:
-                    childlist.append(key)
-        BonesData[bone]['children'] = childlist
-
-def calcHelperBones(BonesData):
-    count = 0
-    helperBones = {}
+        BonesData[bone]['children'] = []
     for bone in BonesData.keys():
-        if (len(BonesData[bone]['children']) == 0) or (len(BonesData[bone]['children']) > 1):
-            HelperBone = {}            
-            HelperBone['position'] = [0.2,0.0,0.0]
-            HelperBone['parent'] = bone
-            HelperBone['rotation'] = [1.0,0.0,0.0,0.0]
-            HelperBone['flag'] = 'helper'
-            HelperBone['name'] = 'Helper'+str(count)
-            HelperBone['children'] = []
-            helperBones['Helper'+str(count)] = HelperBone
-            count+=1
-    for hBone in helperBones.keys():
-        BonesData[hBone] = helperBones[hBone]
-    
-def calcZeroBones(BonesData):
-    zeroBones = {}
+        if 'parent' in BonesData[bone]:
+            BonesData[BonesData[bone]['parent']]['children'].append(bone)
+
+def calcBoneOrder(BonesData):
+    # bone names in topological order (parents before children)
+    order = [bone for bone in BonesData.keys() if 'parent' not in BonesData[bone]]
+    i = 0
+    while i < len(order):
+        order.extend(BonesData[order[i]]['children'])
+        i += 1
+    return order
+
+def calcBoneLengths(BonesData):
+    # bone points to its child if it has exactly one (not at the same place),
+    # otherwise it has default length
     for bone in BonesData.keys():
-        pos = BonesData[bone]['position']
-        if (math.sqrt(pos[0]**2+pos[1]**2+pos[2]**2)) == 0:
-            ZeroBone = {}
-            ZeroBone['position'] = [0.2,0.0,0.0]
-            ZeroBone['rotation'] = [1.0,0.0,0.0,0.0]
-            if 'parent' in BonesData[bone]:
-                ZeroBone['parent'] = BonesData[bone]['parent']
-            ZeroBone['flag'] = 'zerobone'
-            ZeroBone['name'] = 'Zero'+bone 
-            ZeroBone['children'] = []           
-            zeroBones['Zero'+bone] = ZeroBone
-            if 'parent' in BonesData[bone]:
-                BonesData[BonesData[bone]['parent']]['children'].append('Zero'+bone)
-    for hBone in zeroBones.keys():
-        BonesData[hBone] = zeroBones[hBone]
+        children = BonesData[bone]['children']
+        length = 0.2
+        if len(children)==1:
+            childLength = calcBoneLength(BonesData[children[0]]['position'])
+            if childLength > 0:
+                length = childLength
+        BonesData[bone]['length'] = length
 
 def calcBoneHeadPositions(BonesData):
-    
-    for key in BonesData.keys():
-        
-        start = 0        
-        thisbone = key
-        posh = BonesData[key]['position']
-        #print ("SetBonesASPositions: bone=%s, org. position=%s" % (key, posh))
-        while start == 0:
-            if 'parent' in BonesData[thisbone]:
-                parentbone = BonesData[thisbone]['parent']
-                prot = BonesData[parentbone]['rotation']
-                ppos = BonesData[parentbone]['position']            
-                
-                #protmat = RotationMatrix(math.degrees(prot[3]),3,'r',Vector(prot[0],prot[1],prot[2])).invert()
-                protmat = Matrix.Rotation(prot[3],3,Vector([prot[0],prot[1],prot[2]])).inverted()
-                #print ("SetBonesASPositions: bone=%s, protmat=%s" % (key, protmat))
-                #print(protmat)
-                #newposh = protmat * Vector([posh[0],posh[1],posh[2]]) 
-                #newposh =  protmat * Vector([posh[2],posh[1],posh[0]]) #02
-                newposh =  protmat.transposed() * Vector([posh[0],posh[1],posh[2]]) #03
-                #print ("SetBonesASPositions: bone=%s, newposh=%s" % (key, newposh))
-                positionh = VectorSum(ppos,newposh)
-            
-                posh = positionh
-                
-                thisbone = parentbone
-            else:
-                start = 1
+    # armature space head = parent head + parent's accumulated rotation *
+    # bone position, computed once per bone in topological order
+    rotations = {}
+    for key in calcBoneOrder(BonesData):
+        boneData = BonesData[key]
+        rot = boneData['rotation']
+        rotmat = Matrix.Rotation(rot[3],3,Vector([rot[0],rot[1],rot[2]]))
+        posh = boneData['position']
+        if 'parent' in boneData:
+            parentbone = boneData['parent']
+            posh = VectorSum(BonesData[parentbone]['posHAS'], rotations[parentbone] * Vector([posh[0],posh[1],posh[2]]))
+            rotations[key] = rotations[parentbone] * rotmat
+        else:
+            rotations[key] = rotmat
         
         BonesData[key]['posHAS'] = posh
         #print ("SetBonesASPositions: bone=%s, posHAS=%s" % (key, posh))
 
 def calcBoneRotations(BonesDic):
-    
-    objDic =  {}
-    scn = bpy.context.scene
-    #scn = Scene.GetCurrent()
-    for bone in BonesDic.keys():
-        #obj = Object.New('Empty',bone)
-        obj = bpy.data.objects.new(bone, None)
-        objDic[bone] = obj
-        scn.objects.link(obj)
-    #print("all objects created")
-    #print(bpy.data.objects)
-    for bone in BonesDic.keys():
-        if 'parent' in BonesDic[bone]:
-            #Parent = Object.Get(BonesDic[bone]['parent'])
-            #print(BonesDic[bone]['parent'])
-            Parent = objDic.get(BonesDic[bone]['parent'])
-            object = objDic.get(bone)
-            object.parent = Parent
-            #Parent.makeParent([object])
-    #print("all parents linked")
-    for bone in BonesDic.keys():
-        obj = objDic.get(bone)
+    # armature space rotation matrices (Blender axes), composed from parent
+    # rotations in topological order - same as world rotation of parented
+    # objects with Ogre bone transforms, but without touching the scene
+    for bone in calcBoneOrder(BonesDic):
         rot = BonesDic[bone]['rotation']
-        loc = BonesDic[bone]['position']
-        #print ("CreateEmptys:bone=%s, rot=%s" % (bone, rot))
-        #print ("CreateEmptys:bone=%s, loc=%s" % (bone, loc))
-        euler = Matrix.Rotation(rot[3],3,Vector([rot[0],-rot[2],rot[1]])).to_euler()
-        obj.location = [loc[0],-loc[2],loc[1]]
-        #print ("CreateEmptys:bone=%s, euler=%s" % (bone, euler))
-        #print ("CreateEmptys:bone=%s, obj.rotation_euler=%s" % (bone,[math.radians(euler[0]),math.radians(euler[1]),math.radians(euler[2])]))
-        #obj.rotation_euler = [math.radians(euler[0]),math.radians(euler[1]),math.radians(euler[2])]
-        #print ("CreateEmptys:bone=%s, obj.rotation_euler=%s" % (bone,[euler[0],euler[1],euler[2]])) # 02
-        obj.rotation_euler = [euler[0],euler[1],euler[2]] # 02
-    #Redraw()
-    scn.update()
-    #print("all objects rotated")
-    for bone in BonesDic.keys():
-        obj = objDic.get(bone)
-        # TODO: need to get rotation matrix out of objects rotation
-        #loc, rot, scale = obj.matrix_local.decompose()
-        loc, rot, scale = obj.matrix_world.decompose() #02
-        rotmatAS = rot.to_matrix()
-        #print(rotmatAS)
-#        obj.rotation_quaternion.
-#        rotmatAS = Matrix(.matrix_local..getMatrix().rotationPart()
-        BonesDic[bone]['rotmatAS'] = rotmatAS
-        #print ("CreateEmptys:bone=%s, rotmatAS=%s" % (bone, rotmatAS))
-    #print("all matrices stored")
-    
-#    for bone in BonesDic.keys():                          
-#        obj = objDic.get(bone)        
-#        scn.objects.unlink(obj)
-#        del obj
-              
-    # TODO cyclic
-    for bone in BonesDic.keys():         
-        obj = objDic.get(bone)
-#        obj.select = True
-#        #bpy.ops.object.select_name(bone, False)
-#        bpy.ops.object.parent_clear(type='CLEAR_KEEP_TRANSFORM')
-        scn.objects.unlink(obj) # TODO: cyclic message in console    
-        #del obj        
-        #bpy.context.scene.objects.unlink(obj)
-        bpy.data.objects.remove(obj)
-        
-    scn.update()
-#    removedObj = {}  
-#    children=1
-#    while children>0:
-#        children=0
-#        for bone in BonesDic.keys():
-#            if('children' in BonesDic[bone].keys() and bone not in removedObj):
-#                if len(BonesDic[bone]['children'])==0:                
-#                    obj = objDic.get(bone)
-#                    scn.objects.unlink(obj)
-#                    del obj
-#                    removedObj[bone]=True
-#                else:
-#                    children+=1
-    
-    #print("all objects removed")
+        rotmat = Matrix.Rotation(rot[3],3,Vector([rot[0],-rot[2],rot[1]]))
+        if 'parent' in BonesDic[bone]:
+            rotmat = BonesDic[BonesDic[bone]['parent']]['rotmatAS'] * rotmat
+        BonesDic[bone]['rotmatAS'] = rotmat
+        #print ("calcBoneRotations: bone=%s, rotmatAS=%s" % (bone, rotmatAS))
+
+def calcPoseTrack(track, boneData):
+    # TRACK -> channels of pose bone (location, rotation_quaternion, scale),
+    # converted for all keyframes at once. Ogre adds keyframe translation to
+    # bind position and rotates after bind orientation, so location is the
+    # translation in bind orientation space. Bone axes x,y,z are z,x,y
+    # of Ogre bone (bone points along Ogre x axis).
+    w, x, y, z = axisAngleToQuaternion(boneData['rotation'])
+    # rows of inverse (transposed) bind rotation matrix
+    r0 = (1-2*(y*y+z*z), 2*(x*y+w*z), 2*(x*z-w*y))
+    r1 = (2*(x*y-w*z), 1-2*(x*x+z*z), 2*(y*z+w*x))
+    r2 = (2*(x*z+w*y), 2*(y*z-w*x), 1-2*(x*x+y*y))
+
+    translations = track['translations']
+    tx = translations[0::3]
+    ty = translations[1::3]
+    tz = translations[2::3]
+    lx, ly, lz = [[r[0]*a + r[1]*b + r[2]*c for a, b, c in zip(tx, ty, tz)]
+                  for r in (r0, r1, r2)]
+
+    # q and -q are the same rotation, keep neighbouring keys on the same
+    # side so interpolated curves don't flip
+    rotations = array('f', track['rotations'])
+    for i in range(4, len(rotations), 4):
+        dot = rotations[i]*rotations[i-4] + rotations[i+1]*rotations[i-3] + \
+              rotations[i+2]*rotations[i-2] + rotations[i+3]*rotations[i-1]
+        if dot < 0.0:
+            rotations[i:i+4] = array('f', [-v for v in rotations[i:i+4]])
+
+    scales = track['scales']
+    channels = {}
+    channels['location'] = [lz, lx, ly]
+    channels['rotation_quaternion'] = [rotations[0::4], rotations[3::4],
+                                       rotations[1::4], rotations[2::4]]
+    channels['scale'] = [scales[2::3], scales[0::3], scales[1::3]]
+    return channels
 
 def VectorSum(vec1,vec2):
     vecout = [0,0,0]
@@ -668,7 +759,9 @@ def calcBoneLength(vec):
 def bCreateMesh(meshData, folder, name, filepath):
     
     if 'skeleton' in meshData:
-        bCreateSkeleton(meshData, name)
+        rig = bCreateSkeleton(meshData, name)
+        if meshData.get('animations'):
+            registerAnimations(meshData, rig)
     # from collected data create all sub meshes
     subObjs = bCreateSubMeshes(meshData, name)
     # skin submeshes
@@ -702,19 +795,22 @@ def bCreateSkeleton(meshData, name):
     scn.objects.active = rig
     scn.update()
     
+    # all bones are created in one edit mode session, parents first so
+    # parent can be linked right away
     bpy.ops.object.mode_set(mode='EDIT')
-    for bone in bonesData.keys():
+    editBones = {}
+    for bone in calcBoneOrder(bonesData):
         boneData = bonesData[bone]
         boneName = boneData['name']
         
-        children = boneData['children']
         boneObj = amt.edit_bones.new(boneName)
+        editBones[bone] = boneObj
+        if 'parent' in boneData:
+            boneObj.parent = editBones[boneData['parent']]
         #boneObj.head = boneData['posHAS']
         #headPos = boneData['posHAS']
         headPos = boneData['posHAS']
-        tailVector = 0.2
-        if len(children)==1:
-            tailVector=calcBoneLength(bonesData[children[0]]['position'])
+        tailVector = boneData['length']
         
         #boneObj.head = Vector([headPos[0],-headPos[2],headPos[1]])
         #boneObj.tail = Vector([headPos[0],-headPos[2],headPos[1] + tailVector]) 
@@ -770,30 +866,8 @@ def bCreateSkeleton(meshData, name):
         #amt.bones[bone] = boneObj
         #amt.update_tag(refresh)
         
-    # only after all bones are created we can link parents    
-    for bone in bonesData.keys():
-        boneData = bonesData[bone]
-        parent = None
-        if 'parent' in boneData.keys():
-            parent = boneData['parent']
-            # get bone obj
-            boneData = bonesData[bone]
-            boneName = boneData['name']
-            boneObj = amt.edit_bones[boneName]        
-            boneObj.parent = amt.edit_bones[parent]
-    
-    # need to refresh armature before removing bones
-    bpy.ops.object.mode_set(mode='OBJECT')
-    bpy.ops.object.mode_set(mode='EDIT')
-    
-    # delete helper/zero bones
-    for bone in amt.bones.keys():
-        #print("keys of bone=%s" % bonesData[bone].keys())
-        if 'flag' in bonesData[bone].keys():                      
-            #print ("deleting bone=%s" % bone)          
-            bpy.context.object.data.edit_bones.remove(amt.edit_bones[bone])            
-            
     bpy.ops.object.mode_set(mode='OBJECT')
+    return rig
 #    for (bname, pname, vector) in boneTable:        
 #        bone = amt.edit_bones.new(bname)
 #        if pname:
@@ -808,6 +882,232 @@ def bCreateSkeleton(meshData, name):
 #        bone.tail = rot * Vector(vector) + bone.head
 #    bpy.ops.object.mode_set(mode='OBJECT')
 
+def registerAnimations(meshData, rig):
+    # animations are only listed for armature, first one is activated
+    index = {}
+    index['skeleton'] = meshData['skeleton']
+    index['boneIDs'] = meshData['boneIDs']
+    index['animations'] = collections.OrderedDict()
+    for animation in meshData['animations']:
+        index['animations'][animation['name']] = animation
+    animationIndex[rig.name] = index
+    rig['tl_animation_index'] = rig.name
+    print("%s: %d animations" % (rig.name, len(index['animations'])))
+    activateAnimation(rig, meshData['animations'][0]['name'])
+
+def getAnimationIndex(rig):
+    if rig is None:
+        return None
+    return animationIndex.get(rig.get('tl_animation_index'))
+
+def activateAnimation(rig, animationName):
+    # assigns action of animation to armature, keyframes are loaded and baked
+    # if it isn't resident, least recently activated actions over
+    # MAX_RESIDENT_ACTIONS are removed, returns None when animation can't be
+    # read (armature keeps its action)
+    index = getAnimationIndex(rig)
+    key = (rig.get('tl_animation_index'), animationName)
+    action = None
+    if key in residentActions:
+        action = bpy.data.actions.get(residentActions[key])
+    if action is None:
+        animation = index['animations'][animationName]
+        tracks = animation['tracks']
+        if tracks is None:
+            try:
+                tracks = binLoadAnimation(animation, index['boneIDs'])
+            except (IOError, TLBinary.OgreBinaryError) as e:
+                print("WARNING: Can't read animation %s from %s (%s)" % (animationName, animation['file'], e))
+                return None
+        action = bBakeAnimation(animation['name'], tracks, index['skeleton'])
+        residentActions[key] = action.name
+    residentActions.move_to_end(key)
+
+    if rig.animation_data is None:
+        rig.animation_data_create()
+    rig.animation_data.action = action
+
+    evictActions(key)
+    return action
+
+def evictActions(activeKey):
+    # removes least recently activated actions over MAX_RESIDENT_ACTIONS,
+    # actions still used (e.g. by NLA) stay resident and next one is removed
+    # instead, so activating them again doesn't bake a duplicate
+    excess = len(residentActions) - MAX_RESIDENT_ACTIONS
+    for oldKey in list(residentActions.keys()):
+        if excess <= 0:
+            break
+        if oldKey == activeKey:
+            continue
+        oldAction = bpy.data.actions.get(residentActions[oldKey])
+        if oldAction is not None:
+            users = oldAction.users
+            if oldAction.use_fake_user:
+                users -= 1
+            if users > 0:
+                continue
+            oldAction.use_fake_user = False
+            bpy.data.actions.remove(oldAction)
+        del residentActions[oldKey]
+        excess -= 1
+
+def bBakeAnimation(name, tracks, bonesData):
+    # action with F-Curves of all tracks
+    fps = bpy.context.scene.render.fps
+    frameStart = bpy.context.scene.frame_start
+    action = bpy.data.actions.new(name)
+    # keep action not assigned to any object when saving .blend
+    action.use_fake_user = True
+    for bone, track in sorted(tracks.items()):
+        if bone not in bonesData or len(track['times']) == 0:
+            continue
+        boneName = bonesData[bone]['name']
+        frames = array('f', [frameStart + time*fps for time in track['times']])
+        channels = calcPoseTrack(track, bonesData[bone])
+        for channel in ('location', 'rotation_quaternion', 'scale'):
+            if channel == 'scale' and min(track['scales']) == max(track['scales']) == 1.0:
+                continue
+            dataPath = 'pose.bones["%s"].%s' % (boneName, channel)
+            bCreateFCurves(action, dataPath, boneName, frames, channels[channel])
+    return action
+
+def bCreateFCurves(action, dataPath, group, frames, channelValues):
+    # keyframes of every F-Curve are added and filled at once
+    for index, values in enumerate(channelValues):
+        fcurve = action.fcurves.new(data_path=dataPath, index=index, action_group=group)
+        fcurve.keyframe_points.add(len(frames))
+        co = array('f', [0.0]) * (2*len(frames))
+        co[0::2] = frames
+        co[1::2] = array('f', values)
+        fcurve.keyframe_points.foreach_set("co", co)
+        # recalculate handles of added keyframes
+        fcurve.update()
+
+def bCreateGeometry(me, geometry, faces):
+    # fills empty mesh with vertices and triangles using flat buffers
+    # (Blender 2.63+), loops are created in same order as faces array
+    me.vertices.add(geometry.vertexCount())
+    me.vertices.foreach_set("co", geometry.positions)
+    if geometry.normals is not None:
+        me.vertices.foreach_set("normal", geometry.normals)
+    
+    faceCount = TLGeometry.faceCount(faces)
+    me.loops.add(faceCount*3)
+    me.loops.foreach_set("vertex_index", faces[0:faceCount*3])
+    me.polygons.add(faceCount)
+    me.polygons.foreach_set("loop_start", array('I', range(0, faceCount*3, 3)))
+    me.polygons.foreach_set("loop_total", array('I', [3]) * faceCount)
+    me.polygons.foreach_set("use_smooth", [True] * faceCount)
+
+def bCreateVertexGroups(ob, assignments, boneIDtoName):
+    # groups assignments by bone and weight, bone name is resolved once per
+    # bone and there is one add call per (bone, weight) group
+    boneToWeights = {}
+    for v, boneIndex, w in zip(*assignments):
+        if boneIndex not in boneToWeights:
+            boneToWeights[boneIndex] = {}
+        weightToVertices = boneToWeights[boneIndex]
+        if w not in weightToVertices:
+            weightToVertices[w] = []
+        weightToVertices[w].append(v)
+    
+    for boneIndex in sorted(boneToWeights):
+        VG = str(boneIndex)
+        if VG in boneIDtoName:
+            VG = boneIDtoName[VG]
+        #print("creating VGroup %s" % VG)
+        grp = ob.vertex_groups.new(VG)
+        for w, vertices in boneToWeights[boneIndex].items():
+            grp.add(vertices, w, 'REPLACE')
+
+def bGetTexture(texturePath):
+    # image texture for file, loaded only once per session
+    texturePath = os.path.normcase(os.path.abspath(texturePath))
+    tex = None
+    if texturePath in importedTextures:
+        tex = bpy.data.textures.get(importedTextures[texturePath])
+        # texture could be removed, renamed or changed since
+        if tex is not None:
+            if tex.type != 'IMAGE' or tex.image is None or \
+               os.path.normcase(os.path.abspath(bpy.path.abspath(tex.image.filepath))) != texturePath:
+                tex = None
+    if tex is None:
+        tex = bpy.data.textures.new('ColorTex', type = 'IMAGE')
+        tex.image = bpy.data.images.load(texturePath)
+        tex.use_alpha = True
+        importedTextures[texturePath] = tex.name
+    return tex
+
+def bMaterialMatches(mat, matInfo, tex):
+    # checks if material created by import still has given properties
+    def close(a, b):
+        return abs(a - b) < 0.0001
+    if not mat.use_shadeless or len(mat.texture_slots)==0 or mat.texture_slots[0] is None:
+        return False
+    if mat.texture_slots[0].texture != tex:
+        return False
+    if 'ambient' in matInfo and not close(mat.ambient, matInfo['ambient'][0]):
+        return False
+    if 'emissive' in matInfo and not close(mat.emit, matInfo['emissive'][0]):
+        return False
+    for key, color in (('diffuse', mat.diffuse_color), ('specular', mat.specular_color)):
+        if key in matInfo:
+            for c in range(3):
+                if not close(color[c], matInfo[key][c]):
+                    return False
+    return True
+
+def bGetMaterial(name, matInfo, tex):
+    # reuses identical material created by earlier import in this session
+    for matName in importedMaterials.get(name, []):
+        mat = bpy.data.materials.get(matName)
+        if mat is not None and bMaterialMatches(mat, matInfo, tex):
+            return mat
+    
+    # Create shadeless material and MTex
+    mat = bpy.data.materials.new(name)
+    # ambient
+    if 'ambient' in matInfo:
+        mat.ambient = matInfo['ambient'][0]
+    # diffuse
+    if 'diffuse' in matInfo:
+        mat.diffuse_color = matInfo['diffuse']
+    # specular
+    if 'specular' in matInfo:
+        mat.specular_color = matInfo['specular']
+    # emmisive
+    if 'emissive' in matInfo:
+        mat.emit = matInfo['emissive'][0]
+    mat.use_shadeless = True
+    mtex = mat.texture_slots.add()
+    if tex is not None:
+        mtex.texture = tex
+    mtex.texture_coords = 'UV'
+    mtex.use_map_color_diffuse = True 
+    
+    if name not in importedMaterials:
+        importedMaterials[name] = []
+    importedMaterials[name].append(mat.name)
+    return mat
+
+def bAttachMaterial(ob, name, matInfo):
+    # material for the submesh
+    # Create image texture from image.         
+    tex = None
+    if matInfo.get('texture'):
+        tex = bGetTexture(matInfo['texture'])
+    
+    mat = bGetMaterial(name, matInfo, tex)
+    # add material to object
+    ob.data.materials.append(mat)
+    
+    if tex is not None:
+        # this will link image to faces
+        for uvLayer in ob.data.uv_textures:
+            for f in uvLayer.data:
+                f.image=tex.image
+
 def bCreateSubMeshes(meshData, meshName):
     
     allObjects = []
@@ -830,134 +1130,76 @@ def bCreateSubMeshes(meshData, meshName):
         else:
             geometry = meshData['sharedgeometry']            
           
-        verts = geometry['positions'] 
         faces = subMeshData['faces']
         hasNormals = False
-        if 'normals' in geometry.keys():
-            normals = geometry['normals']    
+        if geometry.normals is not None:
             hasNormals = True 
         # mesh vertices and faces   
         
         if(blender_version<=262):
             # vertices and faces of mesh
-            me.from_pydata(verts, [], faces)      
+            verts = [geometry.position(i) for i in range(geometry.vertexCount())]
+            me.from_pydata(verts, [], [faces[i:i+3] for i in range(0, len(faces), 3)])      
             # mesh normals
             c = 0
             for v in me.vertices:
                 if hasNormals:                    
-                    v.normal = Vector((normals[c][0],normals[c][1],normals[c][2]))
+                    v.normal = Vector(geometry.normal(c))
                     c+=1       
         elif(blender_version>262): 
-            # vertices and faces of mesh           
-            VertLength = len(verts)
-            FaceLength = len(faces)
-            me.vertices.add(VertLength)
-            me.tessfaces.add(FaceLength)
-            for i in range(VertLength):
-                me.vertices[i].co=verts[i]
-                if hasNormals:
-                    me.vertices[i].normal = Vector((normals[i][0],normals[i][1],normals[i][2]))
-            #me.vertices[VertLength].co = verts[0]            
-            for i in range(FaceLength):
-                NewFace = (faces[i][0],faces[i][1],faces[i][2],0)                
-                me.tessfaces[i].vertices_raw=NewFace
+            # vertices, polygons and loops of mesh
+            bCreateGeometry(me, geometry, faces)
             
         # blender 2.62 <-> 2.63 compatibility
         if(blender_version<=262):
             meshFaces = me.faces
             meshUV_textures = me.uv_textures
             meshVertex_colors = me.vertex_colors
+            # smooth        
+            for f in meshFaces:
+                f.use_smooth = True
         elif(blender_version>262): 
-            meshFaces = me.tessfaces 
-            meshUV_textures = me.tessface_uv_textures 
-            meshVertex_colors = me.tessface_vertex_colors
-            #meshUV_textures = me.uv_textures   
-        
-        # smooth        
-        for f in meshFaces:
-            f.use_smooth = True
-                      
-        hasTexture = False
-        # material for the submesh
-        # Create image texture from image.         
-        if subMeshName in meshData['materials']:            
-            matInfo = meshData['materials'][subMeshName] # material data
-            if 'texture' in matInfo:
-                texturePath = matInfo['texture']
-                if texturePath:
-                    hasTexture = True
-                    # try to find among already loaded images
-                    tex = None
-                    for lTex in bpy.data.textures:
-                        if lTex.type == 'IMAGE':
-                            if lTex.image.name == matInfo['imageNameOnly']:
-                                tex = lTex
-                                break;
-                    if not tex:
-                        tex = bpy.data.textures.new('ColorTex', type = 'IMAGE')
-                        tex.image = bpy.data.images.load(texturePath)
-                        tex.use_alpha = True
-         
-            # Create shadeless material and MTex
-            mat = bpy.data.materials.new(subMeshName)
-            # ambient
-            if 'ambient' in matInfo:
-                mat.ambient = matInfo['ambient'][0]
-            # diffuse
-            if 'diffuse' in matInfo:
-                mat.diffuse_color = matInfo['diffuse']
-            # specular
-            if 'specular' in matInfo:
-                mat.specular_color = matInfo['specular']
-            # emmisive
-            if 'emissive' in matInfo:
-                mat.emit = matInfo['emissive'][0]
-            mat.use_shadeless = True
-            mtex = mat.texture_slots.add()
-            if hasTexture:
-                mtex.texture = tex
-            mtex.texture_coords = 'UV'
-            mtex.use_map_color_diffuse = True 
-            
-            # add material to object
-            ob.data.materials.append(mat)
-            #print(me.uv_textures[0].data.values()[0].image)       
+            meshFaces = me.polygons 
+            meshUV_textures = me.uv_textures 
+            meshVertex_colors = me.vertex_colors
             
         # texture coordinates
-        if 'texcoordsets' in geometry:
-            for j in range(geometry['texcoordsets']):                
+        if geometry.texCoordSets() > 0:
+            for j in range(geometry.texCoordSets()):                
                 uvLayer = meshUV_textures.new('UVLayer'+str(j))
                 
                 meshUV_textures.active = uvLayer
             
-                for f in meshFaces:    
-                    if 'uvsets' in geometry:
-                        uvco1sets = geometry['uvsets'][f.vertices[0]]
-                        uvco2sets = geometry['uvsets'][f.vertices[1]]
-                        uvco3sets = geometry['uvsets'][f.vertices[2]]
-                        uvco1 = Vector((uvco1sets[j][0],uvco1sets[j][1]))
-                        uvco2 = Vector((uvco2sets[j][0],uvco2sets[j][1]))
-                        uvco3 = Vector((uvco3sets[j][0],uvco3sets[j][1]))
+                if(blender_version<=262):
+                    for f in meshFaces:    
+                        uvco1 = Vector(geometry.uv(f.vertices[0], j))
+                        uvco2 = Vector(geometry.uv(f.vertices[1], j))
+                        uvco3 = Vector(geometry.uv(f.vertices[2], j))
                         uvLayer.data[f.index].uv = (uvco1,uvco2,uvco3)
-                        if hasTexture:
-                            # this will link image to faces
-                            uvLayer.data[f.index].image=tex.image
-                            #uvLayer.data[f.index].use_image=True
+                elif(blender_version>262):
+                    # uvs are stored per loop, loops follow faces array
+                    me.uv_layers[j].data.foreach_set("uv",
+                        TLGeometry.gatherComponents(geometry.uvsets[j], 2, faces))
         
         # vertex colors 
-        if 'vertexcolors' in geometry:
+        if geometry.vertexcolors is not None:
             #for j in range(geometry['texcoordsets']):                
             colorLayer = meshVertex_colors.new('ColorLayer')            
             meshVertex_colors.active = colorLayer
-            vcolors = geometry['vertexcolors'] 
-            for f in meshFaces:    
-                if 'uvsets' in geometry:                    
-                    colv1 = vcolors[f.vertices[0]]
-                    colv2 = vcolors[f.vertices[1]]
-                    colv3 = vcolors[f.vertices[2]]                    
-                    colorLayer.data[f.index].color1 = (colv1[0],colv1[1],colv1[2])
-                    colorLayer.data[f.index].color2 = (colv2[0],colv2[1],colv2[2])
-                    colorLayer.data[f.index].color3 = (colv3[0],colv3[1],colv3[2])
+            if(blender_version<=262):
+                for f in meshFaces:    
+                    if geometry.texCoordSets() > 0:                    
+                        colv1 = geometry.vertexColor(f.vertices[0])
+                        colv2 = geometry.vertexColor(f.vertices[1])
+                        colv3 = geometry.vertexColor(f.vertices[2])                    
+                        colorLayer.data[f.index].color1 = (colv1[0],colv1[1],colv1[2])
+                        colorLayer.data[f.index].color2 = (colv2[0],colv2[1],colv2[2])
+                        colorLayer.data[f.index].color3 = (colv3[0],colv3[1],colv3[2])
+            elif(blender_version>262):
+                # colors (without alpha) are stored per loop, loops follow faces array
+                if geometry.texCoordSets() > 0:
+                    colorLayer.data.foreach_set("color",
+                        TLGeometry.gatherComponents(geometry.vertexcolors, 4, faces, 3))
                                         
 #        # this probably doesn't work
 #        # vertex colors               
@@ -975,13 +1217,8 @@ def bCreateSubMeshes(meshData, meshName):
         
         # bone assignments:
         if 'skeleton' in meshData:
-            if 'boneassignments' in geometry.keys():
-                vgroups = geometry['boneassignments']
-                for vgname, vgroup in vgroups.items():
-                    #print("creating VGroup %s" % vgname)
-                    grp = ob.vertex_groups.new(vgname)
-                    for (v, w) in vgroup:
-                        grp.add([v], w, 'REPLACE')
+            if geometry.boneassignments is not None:
+                bCreateVertexGroups(ob, geometry.boneassignments, meshData['boneIDs'])
             # Give mesh object an armature modifier, using vertex groups but
             # not envelopes
             mod = ob.modifiers.new('MyRigModif', 'ARMATURE')
@@ -999,6 +1236,12 @@ def bCreateSubMeshes(meshData, meshName):
         #me.update(calc_edges=True, calc_tessface=True)
         
         allObjects.append(ob)
+    
+    # materials are added once all geometry is created
+    for ob, subMeshData in zip(allObjects, submeshes):
+        subMeshName = subMeshData['material']
+        if subMeshName in meshData['materials']:
+            bAttachMaterial(ob, subMeshName, meshData['materials'][subMeshName])
         
     # forced view mode with textures
     bpy.context.scene.game_settings.material_mode = 'GLSL'
@@ -1012,7 +1255,8 @@ def bCreateSubMeshes(meshData, meshName):
 
 def load(operator, context, filepath,       
          ogreXMLconverter=None,
-         keep_xml=DEFAULT_KEEP_XML,):
+         keep_xml=DEFAULT_KEEP_XML,
+         media_root="",):
     
     global blender_version
     
@@ -1028,11 +1272,20 @@ def load(operator, context, filepath,
         
     filepath = filepath.lower()
     pathMeshXml = filepath  
-    # get the mesh as .xml file
+    ogreMesh = None
+    isBinaryMesh = False
     if (".mesh" in filepath):
         if (".xml" not in filepath):
-            os.system('%s "%s"' % (ogreXMLconverter, filepath))
             pathMeshXml = filepath + ".xml"
+            # read binary mesh directly, converter is only a fallback
+            try:
+                ogreMesh = TLBinary.readMesh(filepath)
+                isBinaryMesh = True
+            except (IOError, TLBinary.OgreBinaryError) as e:
+                print("WARNING: Can't read binary mesh (%s), using OgreXMLConverter" % e)
+            # get the mesh as .xml file
+            if ogreMesh is None:
+                os.system('%s "%s"' % (ogreXMLconverter, filepath))
     else:
         return('CANCELLED')
     
@@ -1041,31 +1294,35 @@ def load(operator, context, filepath,
     nameDotMesh = os.path.splitext(nameDotMeshDotXml)[0]
     onlyName = os.path.splitext(nameDotMesh)[0] 
                 
-    # material
-    meshMaterials = []
+    # material, others are searched in media tree
     nameDotMaterial = onlyName + ".material"
     pathMaterial = os.path.join(folder, nameDotMaterial)
-    if fileExist(pathMaterial)==False:
-        # search directory for .material    
-        for filename in os.listdir(folder):
-            if ".material" in filename:
-                # material file
-                pathMaterial = os.path.join(folder, filename)
-                meshMaterials.append(pathMaterial)
-                #print("alternative material file: %s" % pathMaterial)
-    else:
-        meshMaterials.append(pathMaterial)
+    if not os.path.isfile(pathMaterial):
+        pathMaterial = None
+    if not media_root:
+        media_root = folder
     
     # try to parse xml file
-    xDocMeshData = xOpenFile(pathMeshXml)
+    if ogreMesh is None:
+        ogreMesh = xReadMesh(pathMeshXml)
     
     meshData = {}
-    if xDocMeshData != "None":
+    if ogreMesh is not None:
         # skeleton data
-        # get the mesh as .xml file
-        skeletonFile = xGetSkeletonLink(xDocMeshData, folder)
+        skeletonFile = ogreGetSkeletonLink(ogreMesh, folder)
         # there is valid skeleton link and existing file
+        ogreSkeleton = None
         if(skeletonFile!="None"):
+            # read binary skeleton directly, converter is only a fallback
+            try:
+                ogreSkeleton = TLBinary.readSkeleton(skeletonFile, loadAnimations=False)
+            except (IOError, TLBinary.OgreBinaryError) as e:
+                print("WARNING: Can't read binary skeleton (%s), using OgreXMLConverter" % e)
+        if ogreSkeleton is not None:
+            binCollectBoneData(meshData, ogreSkeleton)
+            links = binCollectAnimationData(meshData, ogreSkeleton, skeletonFile)
+            binCollectAnimationLinks(meshData, links, os.path.dirname(skeletonFile))
+        elif(skeletonFile!="None"):
             skeletonFileXml = skeletonFile + ".xml"
             # if there isn't .xml file yet, convert the skeleton file
             if(not os.path.isfile(skeletonFileXml)):
@@ -1074,19 +1331,24 @@ def load(operator, context, filepath,
             xDocSkeletonData = xOpenFile(skeletonFileXml)    
             if xDocSkeletonData != "None":
                 xCollectBoneData(meshData, xDocSkeletonData)
+                links = xCollectAnimationData(meshData, xDocSkeletonData)
+                binCollectAnimationLinks(meshData, links, os.path.dirname(skeletonFile))
         
         # collect mesh data
         print("collecting mesh data...")
-        xCollectMeshData(meshData, xDocMeshData, onlyName, folder)    
-        xCollectMaterialData(meshData, meshMaterials, folder)
+        ogreCollectMeshData(meshData, ogreMesh)
+        # raw mesh data are not needed anymore
+        ogreMesh = None
+        xCollectMaterialData(meshData, pathMaterial, media_root)
         
         # after collecting is done, start creating stuff#        
         # create skeleton (if any) and mesh from parsed data
         bCreateMesh(meshData, folder, onlyName, pathMeshXml)
         if not keep_xml:
             # cleanup by deleting the XML file we created
-            os.unlink("%s" % pathMeshXml)
-            if 'skeleton' in meshData:
+            if not isBinaryMesh:
+                os.unlink("%s" % pathMeshXml)
+            if 'skeleton' in meshData and ogreSkeleton is None:
                 os.unlink("%s" % skeletonFileXml)
 
             
@@ -0,0 +1,357 @@
+"""
+Name: 'OGRE material script parser for Torchlight'
+Blender: 2.59, 2.62, 2.63a
+
+Author: Dusho
+
+Tokenizes Ogre .material scripts (comments, quoted strings and braces are
+handled) and parses them into nested blocks. Parsed files are cached per
+path and modification time, so importing more meshes from the same folder
+doesn't parse the same files again.
+
+Material names of whole media tree are indexed into file (in temp
+directory, one per media root) mapping material name to file and byte
+offset of its definition. Media tree is scanned only when there isn't
+stored index yet. Entries are validated when they are looked up: file of
+found material is rescanned if its mtime changed, and the tree is scanned
+again (only changed files are read) when a material isn't in the index,
+so materials from other folders are found without walking the tree on
+every import.
+
+MATERIALS: {[material name]: MATERIAL}
+BLOCK (MATERIAL, TECHNIQUE, PASS, TEXTUREUNIT and other blocks):
+['type'] - block keyword ('material', 'technique', 'pass', 'texture_unit', ..)
+['name'] - block name (can be empty)
+['offset'] - offset of block keyword in file (in bytes)
+['properties'] - {[key]: [value, ..]} attributes of block (last one wins)
+['techniques'] - list of TECHNIQUE (material only)
+['passes'] - list of PASS (technique only)
+['textureunits'] - list of TEXTUREUNIT (pass only)
+['blocks'] - list of other nested blocks (shader references, ..)
+MATERIAL also has:
+['parent'] - name of inherited material (or None)
+['file'] - path of .material file
+MATERIALINDEX:
+['root'] - media root
+['files'] - {[filepath]: [mtime, [(material name, offset), ..]]}
+['materials'] - {[material name]: (filepath, offset)} (first definition wins)
+['scanned'] - True if media tree was already scanned for this index
+"""
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+# comments, quoted strings, braces, new lines and words
+TOKEN_RE = re.compile(r'//[^\n]*|/\*.*?\*/|"[^"]*"|[{}]|\n|[^\s{}"]+', re.S)
+
+BLOCK_LISTS = {'technique': 'techniques',
+               'pass': 'passes',
+               'texture_unit': 'textureunits'}
+
+# parsed files {[filepath]: (mtime, MATERIALS)}
+parsedFiles = {}
+
+MATERIAL_INDEX_VERSION = 1
+
+def tokenize(text):
+    # yields (token, offset), comments are skipped and quotes removed
+    for match in TOKEN_RE.finditer(text):
+        token = match.group()
+        if token.startswith('//') or token.startswith('/*'):
+            continue
+        if token.startswith('"'):
+            token = token[1:-1]
+        yield token, match.start()
+
+def newBlock(header, offset):
+    block = {}
+    block['type'] = header[0] if header else ''
+    block['name'] = ' '.join(header[1:])
+    block['offset'] = offset
+    block['properties'] = {}
+    block['blocks'] = []
+    if block['type'] == 'material':
+        # material Name : Parent
+        block['name'] = header[1] if len(header) > 1 else ''
+        block['parent'] = None
+        if len(header) > 3 and header[2] == ':':
+            block['parent'] = header[3]
+    return block
+
+def addProperty(block, statement):
+    block['properties'][statement[0]] = statement[1:]
+
+def addBlock(parent, block):
+    listName = BLOCK_LISTS.get(block['type'], 'blocks')
+    if listName not in parent:
+        parent[listName] = []
+    parent[listName].append(block)
+
+def parseMaterialScript(text):
+    # text should be decoded 1:1 with bytes (latin-1) to get byte offsets
+    script = newBlock([], 0)
+    stack = [script]
+    statement = []
+    statementOffset = 0
+    pending = None
+    pendingOffset = 0
+
+    for token, offset in tokenize(text):
+        if token == '\n':
+            # statement can still be header of block starting on next line
+            if statement:
+                pending, pendingOffset = statement, statementOffset
+                statement = []
+        elif token == '{':
+            if statement:
+                header, headerOffset = statement, statementOffset
+            else:
+                header, headerOffset = pending, pendingOffset
+            block = newBlock(header or [], headerOffset)
+            addBlock(stack[-1], block)
+            stack.append(block)
+            statement = []
+            pending = None
+        elif token == '}':
+            if pending:
+                addProperty(stack[-1], pending)
+            if statement:
+                addProperty(stack[-1], statement)
+            statement = []
+            pending = None
+            if len(stack) > 1:
+                stack.pop()
+        else:
+            if pending:
+                addProperty(stack[-1], pending)
+                pending = None
+            if not statement:
+                statementOffset = offset
+            statement.append(token)
+
+    materials = {}
+    for block in script['blocks']:
+        if block['type'] == 'material':
+            materials[block['name']] = block
+    return materials
+
+def readMaterialFile(filepath):
+    # returns MATERIALS of file, parsed only if file was changed
+    mtime = os.path.getmtime(filepath)
+    cached = parsedFiles.get(filepath)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    filein = open(filepath, 'rb')
+    text = filein.read().decode('latin-1')
+    filein.close()
+    materials = parseMaterialScript(text)
+    for material in materials.values():
+        material['file'] = filepath
+    parsedFiles[filepath] = (mtime, materials)
+    return materials
+
+def rebaseOffsets(block, offset):
+    # adds offset to offsets of block and all its nested blocks
+    block['offset'] += offset
+    for listName in ['blocks'] + list(BLOCK_LISTS.values()):
+        for nested in block.get(listName, []):
+            rebaseOffsets(nested, offset)
+
+def readMaterialAt(filepath, offset):
+    # parses only one material, which definition starts at offset
+    filein = open(filepath, 'rb')
+    filein.seek(offset)
+    text = filein.read().decode('latin-1')
+    filein.close()
+
+    # cut text after closing brace of material
+    depth = 0
+    for token, position in tokenize(text):
+        if token == '{':
+            depth += 1
+        elif token == '}':
+            depth -= 1
+            if depth <= 0:
+                text = text[0:position+1]
+                break
+    for material in parseMaterialScript(text).values():
+        rebaseOffsets(material, offset)
+        material['file'] = filepath
+        return material
+    return None
+
+def scanMaterialNames(text):
+    # [(name, offset), ..] of materials defined in script
+    names = []
+    depth = 0
+    keywordOffset = None
+    for token, offset in tokenize(text):
+        if token == '{':
+            depth += 1
+        elif token == '}':
+            depth -= 1
+        elif token == '\n':
+            continue
+        elif keywordOffset is not None:
+            names.append((token, keywordOffset))
+            keywordOffset = None
+        elif depth == 0 and token == 'material':
+            keywordOffset = offset
+    return names
+
+def getIndexPath(mediaRoot):
+    key = hashlib.md5(os.path.normcase(mediaRoot).encode('utf-8')).hexdigest()
+    return os.path.join(tempfile.gettempdir(), "tl_materials_%s.json" % key)
+
+def scanMaterialFile(filepath):
+    filein = open(filepath, 'rb')
+    text = filein.read().decode('latin-1')
+    filein.close()
+    return [os.path.getmtime(filepath), scanMaterialNames(text)]
+
+def saveMaterialIndex(materialIndex):
+    indexPath = getIndexPath(materialIndex['root'])
+    try:
+        fileout = open(indexPath, 'w')
+        json.dump({'version': MATERIAL_INDEX_VERSION, 'root': materialIndex['root'],
+                   'files': materialIndex['files']}, fileout)
+        fileout.close()
+    except (IOError, OSError) as e:
+        print("WARNING: Can't write material index '%s' (%s)" % (indexPath, e))
+
+def updateMaterialNames(materialIndex):
+    # first definition wins (files are in sorted order)
+    names = {}
+    for filepath in sorted(materialIndex['files']):
+        for name, offset in materialIndex['files'][filepath][1]:
+            if name not in names:
+                names[name] = (filepath, offset)
+    materialIndex['materials'] = names
+
+def scanMediaTree(materialIndex):
+    # walks whole media tree, only new and changed files are read
+    files = materialIndex['files']
+    found = {}
+    changed = False
+    for dirpath, dirnames, filenames in os.walk(materialIndex['root']):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if not filename.lower().endswith(".material"):
+                continue
+            filepath = os.path.join(dirpath, filename)
+            entry = files.get(filepath)
+            if entry is None or entry[0] != os.path.getmtime(filepath):
+                entry = scanMaterialFile(filepath)
+                changed = True
+            found[filepath] = entry
+    if len(found) != len(files):
+        changed = True
+
+    materialIndex['files'] = found
+    materialIndex['scanned'] = True
+    updateMaterialNames(materialIndex)
+    if changed:
+        saveMaterialIndex(materialIndex)
+
+def refreshMaterialFile(materialIndex, filepath):
+    # rescans one indexed file (removes it, if it doesn't exist anymore)
+    try:
+        materialIndex['files'][filepath] = scanMaterialFile(filepath)
+    except (IOError, OSError):
+        del materialIndex['files'][filepath]
+    updateMaterialNames(materialIndex)
+    saveMaterialIndex(materialIndex)
+
+def isMaterialFileCurrent(materialIndex, filepath):
+    try:
+        return materialIndex['files'][filepath][0] == os.path.getmtime(filepath)
+    except (IOError, OSError):
+        return False
+
+def loadMaterialIndex(mediaRoot):
+    # returns MATERIALINDEX of .material files under mediaRoot, stored index
+    # is used as it is (see lookupMaterial), media tree is scanned only if
+    # there isn't any
+    mediaRoot = os.path.abspath(mediaRoot)
+    materialIndex = None
+    try:
+        filein = open(getIndexPath(mediaRoot), 'r')
+        stored = json.load(filein)
+        filein.close()
+        if stored.get('version') == MATERIAL_INDEX_VERSION and stored.get('root') == mediaRoot:
+            materialIndex = {'root': mediaRoot, 'files': stored['files'], 'scanned': False}
+            updateMaterialNames(materialIndex)
+    except (IOError, OSError, ValueError):
+        pass
+
+    if materialIndex is None:
+        materialIndex = {'root': mediaRoot, 'files': {}, 'scanned': False}
+        scanMediaTree(materialIndex)
+    return materialIndex
+
+def lookupMaterial(name, materialIndex):
+    # (filepath, offset) of material, file of entry is checked and rescanned
+    # if it's changed, media tree is scanned again (once per index) if
+    # material isn't found
+    while True:
+        entry = materialIndex['materials'].get(name)
+        if entry is None:
+            if materialIndex['scanned']:
+                return None
+            scanMediaTree(materialIndex)
+        elif isMaterialFileCurrent(materialIndex, entry[0]):
+            return entry
+        else:
+            refreshMaterialFile(materialIndex, entry[0])
+
+def findMaterial(name, materialIndex, materials):
+    # adds material (and materials it inherits from) to MATERIALS using
+    # index, returns the material or None
+    current = name
+    while current is not None and current not in materials:
+        entry = lookupMaterial(current, materialIndex)
+        if entry is None:
+            break
+        filepath, offset = entry
+        material = readMaterialAt(filepath, offset)
+        if material is None or material['name'] != current:
+            print("WARNING: Material index of '%s' is out of date" % filepath)
+            break
+        materials[current] = material
+        current = material['parent']
+    return materials.get(name)
+
+def getColour(properties, key):
+    # [r,g,b] from colour property, None if missing or not numeric
+    # (e.g. 'vertexcolour')
+    values = properties.get(key, [])
+    if len(values) < 3:
+        return None
+    try:
+        return [float(values[0]), float(values[1]), float(values[2])]
+    except ValueError:
+        return None
+
+def getTechniquesOwner(material, materials):
+    # material which defines techniques used by material (the material
+    # itself or inherited one, if material doesn't have own techniques)
+    visited = set()
+    while len(material.get('techniques', [])) == 0:
+        visited.add(material['name'])
+        parent = materials.get(material['parent'])
+        if parent is None or parent['name'] in visited:
+            break
+        material = parent
+    return material
+
+def getPasses(material, materials):
+    # passes of first technique (the one Ogre prefers), techniques of
+    # inherited material are used if material doesn't have own
+    techniques = getTechniquesOwner(material, materials).get('techniques', [])
+    if len(techniques) == 0:
+        return []
+    return techniques[0].get('passes', [])
@@ -39,12 +39,12 @@ This script imports/exports Torchlight Ogre models into/from Blender.
 
 Supported:<br>
     * import/export of basic meshes
-    * import of skeleton
+    * import/export of skeleton
+    * import of skeleton animations (loaded when activated)
     * import/export of vertex weights (ability to import characters and adjust rigs)
 
 Missing:<br>   
-    * skeletons (export)
-    * animations
+    * animation export
     * vertex color export
 
 Known issues:<br>
@@ -83,6 +83,12 @@ if "bpy" in locals():
         imp.reload(TLImport)
     if "TLExport" in locals():
         imp.reload(TLExport)
+    if "TLBinary" in locals():
+        imp.reload(TLBinary)
+    if "TLGeometry" in locals():
+        imp.reload(TLGeometry)
+    if "TLMaterial" in locals():
+        imp.reload(TLMaterial)
 
 # Path for your OgreXmlConverter
 OGRE_XML_CONVERTER = "D:\stuff\Torchlight_modding\orge_tools\OgreXmlConverter.exe"
@@ -113,6 +119,14 @@ class ImportTL(bpy.types.Operator, ImportHelper):
             description="Keeps the XML file when converting from .MESH",
             default=False,
             )
+    
+    media_root = StringProperty(
+            name="Media Root",
+            description="Folder searched (with subfolders) for materials "
+                        "not found next to the mesh, mesh folder if empty",
+            default="",
+            subtype='DIR_PATH',
+            )
 #    
     filter_glob = StringProperty(
             default="*.mesh;*.MESH;.xml;.XML",
@@ -133,6 +147,8 @@ class ImportTL(bpy.types.Operator, ImportHelper):
         layout = self.layout       
         row = layout.row(align=True)
         row.prop(self, "keep_xml")
+        row = layout.row(align=True)
+        row.prop(self, "media_root")
 
 class ExportTL(bpy.types.Operator, ExportHelper):
     '''Export a Torchlight MESH File'''
@@ -145,10 +161,19 @@ class ExportTL(bpy.types.Operator, ExportHelper):
     
     keep_xml = BoolProperty(
             name="Keep XML",
-            description="Keeps the XML file when converting to .MESH",
+            description="Writes also .xml files (for debugging)",
             default=False,   #TODO make default False for release
             )
     
+    ogre_version = EnumProperty(
+            name="Format",
+            description="Version of the exported binary .mesh",
+            items=(('TL1', "Torchlight 1", "Ogre 1.6 mesh (MeshSerializer_v1.40)"),
+                   ('TL2', "Torchlight 2", "Ogre 1.7 mesh (MeshSerializer_v1.41)"),
+                   ),
+            default='TL1',
+            )
+    
     apply_transform = BoolProperty(
             name="Apply Transform",
             description="Applies object's transformation to its data",
@@ -178,6 +203,38 @@ class ExportTL(bpy.types.Operator, ExportHelper):
             description="Exports new skeleton and links the mesh to this new skeleton",
             default=False,   
             )
+    
+    shared_geometry = BoolProperty(
+            name="Shared Geometry",
+            description="Exports one vertex buffer shared by all submeshes "
+                        "(vertices on seams of objects are welded)",
+            default=False,
+            )
+    
+    weld_tolerance = BoolProperty(
+            name="Tolerance Welding",
+            description="Welds vertices which differ less than given epsilons "
+                        "(otherwise only exactly same vertices are welded)",
+            default=False,
+            )
+    
+    weld_position_epsilon = FloatProperty(
+            name="Position Epsilon",
+            description="Maximal difference of welded positions",
+            default=0.0001, min=0.000001, max=1.0, precision=6,
+            )
+    
+    weld_normal_epsilon = FloatProperty(
+            name="Normal Epsilon",
+            description="Maximal difference of welded normals",
+            default=0.001, min=0.0, max=1.0, precision=6,
+            )
+    
+    weld_uv_epsilon = FloatProperty(
+            name="UV Epsilon",
+            description="Maximal difference of welded UV coordinates",
+            default=0.0001, min=0.0, max=1.0, precision=6,
+            )
 
     filter_glob = StringProperty(
             default="*.mesh;*.MESH;.xml;.XML",
@@ -201,6 +258,9 @@ class ExportTL(bpy.types.Operator, ExportHelper):
         row = layout.row(align=True)
         row.prop(self, "keep_xml")
         
+        row = layout.row(align=True)
+        row.prop(self, "ogre_version")
+        
         row = layout.row(align=True)
         row.prop(self, "apply_transform")
         
@@ -215,6 +275,75 @@ class ExportTL(bpy.types.Operator, ExportHelper):
         
         row = layout.row(align=True)
         row.prop(self, "export_and_link_skeleton")
+        
+        row = layout.row(align=True)
+        row.prop(self, "shared_geometry")
+        
+        row = layout.row(align=True)
+        row.prop(self, "weld_tolerance")
+        if self.weld_tolerance:
+            col = layout.column(align=True)
+            col.prop(self, "weld_position_epsilon")
+            col.prop(self, "weld_normal_epsilon")
+            col.prop(self, "weld_uv_epsilon")
+
+
+class ActivateAnimationTL(bpy.types.Operator):
+    '''Load imported Torchlight animation and assign it to armature'''
+    bl_idname = "object.tl_activate_animation"
+    bl_label = "Activate Animation"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    animation = StringProperty(
+            name="Animation",
+            description="Name of animation",
+            default="",
+            )
+
+    @classmethod
+    def poll(cls, context):
+        from . import TLImport
+        return TLImport.getAnimationIndex(context.active_object) is not None
+
+    def execute(self, context):
+        from . import TLImport
+        index = TLImport.getAnimationIndex(context.active_object)
+        if self.animation not in index['animations']:
+            self.report({'ERROR'}, "Unknown animation: %s" % self.animation)
+            return {'CANCELLED'}
+        if TLImport.activateAnimation(context.active_object, self.animation) is None:
+            self.report({'ERROR'}, "Can't read animation: %s" % self.animation)
+            return {'CANCELLED'}
+        return {'FINISHED'}
+
+class AnimationPanelTL(bpy.types.Panel):
+    '''Animations of imported Torchlight skeleton'''
+    bl_label = "Torchlight Animations"
+    bl_space_type = 'PROPERTIES'
+    bl_region_type = 'WINDOW'
+    bl_context = "data"
+
+    @classmethod
+    def poll(cls, context):
+        from . import TLImport
+        return TLImport.getAnimationIndex(context.active_object) is not None
+
+    def draw(self, context):
+        from . import TLImport
+        layout = self.layout
+        rig = context.active_object
+        index = TLImport.getAnimationIndex(rig)
+        active = None
+        if rig.animation_data is not None and rig.animation_data.action is not None:
+            active = rig.animation_data.action.name
+        for animation in index['animations'].values():
+            row = layout.row(align=True)
+            key = (rig['tl_animation_index'], animation['name'])
+            icon = 'ACTION' if TLImport.residentActions.get(key) == active else 'NONE'
+            op = row.operator(ActivateAnimationTL.bl_idname,
+                              text="%s (%.2fs)" % (animation['name'], animation['length']),
+                              icon=icon)
+            op.animation = animation['name']
 
 
 def menu_func_import(self, context):
@@ -5,10 +5,14 @@ if "bpy" in locals():
         imp.reload(TLImport)
     if "TLExport" in locals():
         imp.reload(TLExport)
+    if "TLBinary" in locals():
+        imp.reload(TLBinary)
         
+import TLBinary
 import TLExport
 import TLImport
 import bpy
+import os
 
 OGRE_XML_CONVERTER = "D:\stuff\Torchlight_modding\orge_tools\OgreXmlConverter.exe -q"
 
@@ -26,7 +30,250 @@ def debug_load(self, context, filepath):
     
     TLImport.load(self, context, filepath, OGRE_XML_CONVERTER)
 
+def legacy_xCollectVertexData(data):
+    # per-semantic vertex decoding of importer before single pass reading
+    # (one walk over all vertices for every declared semantic)
+    vertexdata = {}
+    vertices = []
+    normals = []
+    vertexcolors = []
+    
+    for vb in data.childNodes:
+        if vb.localName == 'vertexbuffer':
+            if vb.hasAttribute('positions'):
+                for vertex in vb.getElementsByTagName('vertex'):
+                    for vp in vertex.childNodes:
+                        if vp.localName == 'position':
+                            x = float(vp.getAttributeNode('x').value)
+                            y = -float(vp.getAttributeNode('z').value)
+                            z = float(vp.getAttributeNode('y').value)
+                            vertices.append([x,y,z])
+                vertexdata['positions'] = vertices            
+            
+            if vb.hasAttribute('normals'):
+                for vertex in vb.getElementsByTagName('vertex'):
+                    for vn in vertex.childNodes:
+                        if vn.localName == 'normal':
+                            x = float(vn.getAttributeNode('x').value)
+                            y = -float(vn.getAttributeNode('z').value)
+                            z = float(vn.getAttributeNode('y').value)
+                            normals.append([x,y,z])
+                vertexdata['normals'] = normals                
+            
+            if vb.hasAttribute('colours_diffuse'):
+                for vertex in vb.getElementsByTagName('vertex'):
+                    for vcd in vertex.childNodes:
+                        if vcd.localName == 'colour_diffuse':
+                            rgba = vcd.getAttributeNode('value').value
+                            vertexcolors.append([float(c) for c in rgba.split()[0:4]])
+                vertexdata['vertexcolors'] = vertexcolors
+            
+            if vb.hasAttribute('texture_coord_dimensions_0'):
+                vertexdata['texcoordsets'] = int(vb.getAttributeNode('texture_coords').value)
+                uvcoordset = []
+                for vertex in vb.getElementsByTagName('vertex'):
+                    uvcoords = []
+                    for vt in vertex.childNodes:
+                        if vt.localName == 'texcoord':
+                            u = float(vt.getAttributeNode('u').value)
+                            v = -float(vt.getAttributeNode('v').value)+1.0
+                            uvcoords.append([u,v])
+                    if len(uvcoords) > 0:
+                        uvcoordset.append(uvcoords)
+                vertexdata['uvsets'] = uvcoordset                
+                        
+    return vertexdata
+
+def legacy_xCollectMeshData(xmldoc):
+    # submesh faces, geometry and bone assignments as the importer collected
+    # them before single pass reading
+    meshData = {}
+    for subnodes in xmldoc.getElementsByTagName('sharedgeometry'):
+        meshData['sharedgeometry'] = legacy_xCollectVertexData(subnodes)
+    subMeshData = []
+    for submeshes in xmldoc.getElementsByTagName('submeshes'):
+        for submesh in submeshes.childNodes:
+            if submesh.localName != 'submesh':
+                continue
+            sm = {}
+            sm['material'] = str(submesh.getAttributeNode('material').value)
+            for subnodes in submesh.childNodes:
+                if subnodes.localName == 'faces':
+                    faces = []
+                    for face in subnodes.childNodes:
+                        if face.localName == 'face':
+                            faces.append([int(face.getAttributeNode('v1').value),
+                                          int(face.getAttributeNode('v2').value),
+                                          int(face.getAttributeNode('v3').value)])
+                    sm['faces'] = faces
+                if subnodes.localName == 'geometry':
+                    sm['geometry'] = legacy_xCollectVertexData(subnodes)
+                if subnodes.localName == 'boneassignments':
+                    assignments = []
+                    for vg in subnodes.childNodes:
+                        if vg.localName == 'vertexboneassignment':
+                            assignments.append([int(vg.getAttributeNode('vertexindex').value),
+                                                str(vg.getAttributeNode('boneindex').value),
+                                                float(vg.getAttributeNode('weight').value)])
+                    sm['boneassignments'] = assignments
+            subMeshData.append(sm)
+    meshData['submeshes'] = subMeshData
+    return meshData
+
+def debug_benchmark_xml_read(filepath, repeat=3):
+    # times .mesh.xml decoding of importer before single pass reading
+    # (minidom parse + per-semantic collectors) against the current one
+    # (xReadMesh + ogreCollectMeshData) on the same file
+    import time
+    from xml.dom import minidom
+    
+    def best(function):
+        times = []
+        for i in range(repeat):
+            start = time.time()
+            function()
+            times.append(time.time() - start)
+        return min(times)
+    
+    def legacy():
+        legacy_xCollectMeshData(minidom.parse(filepath))
+    
+    def current():
+        TLImport.ogreCollectMeshData({}, TLImport.xReadMesh(filepath))
+    
+    legacyTime = best(legacy)
+    currentTime = best(current)
+    print("per-semantic (minidom): %.3fs, single pass: %.3fs (%.1fx)" %
+          (legacyTime, currentTime, legacyTime / max(currentTime, 1e-9)))
+
+def debug_benchmark_mesh_build(filepath):
+    # times per element mesh construction against foreach_set (TLImport.bCreateGeometry)
+    import time
+    
+    meshData = {}
+    TLImport.ogreCollectMeshData(meshData, TLBinary.readMesh(filepath))
+    for subMeshData in meshData['submeshes']:
+        if 'geometry' in subMeshData:
+            geometry = subMeshData['geometry']
+        else:
+            geometry = meshData['sharedgeometry']
+        faces = subMeshData['faces']
+        vertexCount = geometry.vertexCount()
+        faceCount = len(faces) // 3
+        
+        start = time.time()
+        me = bpy.data.meshes.new("benchmark")
+        me.vertices.add(vertexCount)
+        me.tessfaces.add(faceCount)
+        for i in range(vertexCount):
+            me.vertices[i].co = geometry.position(i)
+            if geometry.normals is not None:
+                me.vertices[i].normal = geometry.normal(i)
+        for i in range(faceCount):
+            me.tessfaces[i].vertices_raw = (faces[i*3],faces[i*3+1],faces[i*3+2],0)
+        me.update(calc_edges=True)
+        perElement = time.time() - start
+        bpy.data.meshes.remove(me)
+        
+        start = time.time()
+        me = bpy.data.meshes.new("benchmark")
+        TLImport.bCreateGeometry(me, geometry, faces)
+        me.update(calc_edges=True)
+        bulk = time.time() - start
+        bpy.data.meshes.remove(me)
+        
+        print("%s: %d vertices, %d faces, per element: %.3fs, foreach_set: %.3fs" %
+              (subMeshData['material'], vertexCount, faceCount, perElement, bulk))
+
+def debug_benchmark_vertex_groups(filepath):
+    # times per assignment vertex group adds against TLImport.bCreateVertexGroups
+    import time
+    
+    meshData = {}
+    ogreMesh = TLBinary.readMesh(filepath)
+    skeletonFile = TLImport.ogreGetSkeletonLink(ogreMesh, os.path.split(filepath)[0])
+    if skeletonFile != "None":
+        TLImport.binCollectBoneData(meshData, TLBinary.readSkeleton(skeletonFile))
+    TLImport.ogreCollectMeshData(meshData, ogreMesh)
+    for subMeshData in meshData['submeshes']:
+        if 'geometry' in subMeshData:
+            geometry = subMeshData['geometry']
+        else:
+            geometry = meshData['sharedgeometry']
+        if geometry.boneassignments is None:
+            continue
+        me = bpy.data.meshes.new("benchmark")
+        TLImport.bCreateGeometry(me, geometry, subMeshData['faces'])
+        ob = bpy.data.objects.new("benchmark", me)
+        
+        start = time.time()
+        assignmentCount = 0
+        for v, boneIndex, w in zip(*geometry.boneassignments):
+            vgname = meshData['boneIDs'].get(str(boneIndex), str(boneIndex))
+            if vgname in ob.vertex_groups:
+                grp = ob.vertex_groups[vgname]
+            else:
+                grp = ob.vertex_groups.new(vgname)
+            grp.add([v], w, 'REPLACE')
+            assignmentCount += 1
+        perAssignment = time.time() - start
+        ob.vertex_groups.clear()
+        
+        start = time.time()
+        TLImport.bCreateVertexGroups(ob, geometry.boneassignments, meshData['boneIDs'])
+        grouped = time.time() - start
+        
+        bpy.data.objects.remove(ob)
+        bpy.data.meshes.remove(me)
+        print("%s: %d assignments, per assignment: %.3fs, grouped: %.3fs" %
+              (subMeshData['material'], assignmentCount, perAssignment, grouped))
+
+def debug_benchmark_vertex_welding(sizes=(1000, 2000, 4000, 8000, 16000), linearUpTo=4000):
+    # times TLExport.getVertexIndex on grid meshes of growing size, time per
+    # corner should stay the same; old linear search is timed for small grids
+    import time
+    
+    for size in sizes:
+        side = int(size ** 0.5)
+        vertices = [TLExport.VertexInfo(x, y, 0.0, 0.0, 0.0, 1.0, x/side, y/side, {0: 1.0})
+                    for y in range(side) for x in range(side)]
+        corners = []
+        for y in range(side-1):
+            for x in range(side-1):
+                i = y*side + x
+                corners.extend((i, i+1, i+side+1, i, i+side+1, i+side))
+        
+        start = time.time()
+        vertexList = []
+        vertexIndex = {}
+        for i in corners:
+            vert = vertices[i]
+            vert = TLExport.VertexInfo(vert.px, vert.py, vert.pz, vert.nx, vert.ny, vert.nz,
+                                       vert.u, vert.v, dict(vert.boneWeights))
+            TLExport.getVertexIndex(vert, vertexList, vertexIndex)
+        hashed = time.time() - start
+        
+        linear = "-"
+        if size <= linearUpTo:
+            start = time.time()
+            vertexList = []
+            for i in corners:
+                vert = vertices[i]
+                for vert2 in vertexList:
+                    if vert == vert2:
+                        break
+                else:
+                    vertexList.append(vert)
+            linear = "%.3fs" % (time.time() - start)
+        
+        print("%d vertices, %d corners: hashed %.3fs (%.2fus per corner), linear %s" %
+              (len(vertexList), len(corners), hashed, hashed*1e6/max(1, len(corners)), linear))
+
 #TLImport.test()
+#debug_benchmark_vertex_welding()
+#debug_benchmark_vertex_groups("D:\\stuff\\Torchlight_modding\\TL2_char_M\\HUM_M.MESH")
+#debug_benchmark_mesh_build("D:\\stuff\\Torchlight_modding\\TL2_char_M\\HUM_M.MESH")
+#debug_benchmark_xml_read("D:\\stuff\\Torchlight_modding\\TL2_char_M\\HUM_M.MESH.xml")
 #debug_load(0, bpy.context, "D:\\stuff\\Torchlight_modding\\org_models\\Alchemist\\Alchemist.MESH") 
 #debug_load(0, bpy.context, "D:\\stuff\\Torchlight_modding\\TL2_char_M\\HUM_M.MESH")
 #debug_load(0, bpy.context, "D:\\stuff\\Torchlight_modding\\org_models\\cave_floor\\cave_floor_decal_01.Mesh")
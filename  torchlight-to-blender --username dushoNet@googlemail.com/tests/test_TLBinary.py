@@ -0,0 +1,275 @@
+"""
+Tests of TLBinary (run with pytest or unittest from this folder). Meshes and
+skeletons are written with the writers and read back with the readers.
+"""
+
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import TLBinary
+
+def newGeometry(vertexCount, colours=False, texCoords=True):
+    # values are exactly representable as 32bit floats
+    elements = []
+    positions = []
+    normals = []
+    uvs = []
+    for i in range(vertexCount):
+        positions.extend([i * 0.5, -i * 0.25, 1.0])
+        normals.extend([0.0, 0.0, 1.0])
+        uvs.extend([(i % 4) * 0.25, 0.5])
+    elements.append((TLBinary.VES_POSITION, 0, 3, positions))
+    elements.append((TLBinary.VES_NORMAL, 0, 3, normals))
+    if colours:
+        values = []
+        for i in range(vertexCount):
+            values.extend([1.0, (i % 6) * 51 / 255.0, 0.0, 1.0])
+        elements.append((TLBinary.VES_DIFFUSE, 0, 4, values))
+    if texCoords:
+        elements.append((TLBinary.VES_TEXTURE_COORDINATES, 0, 2, uvs))
+    return {'vertexcount': vertexCount, 'elements': elements}
+
+def newBoneAssignments(assignments):
+    boneAssignments = TLBinary.newBoneAssignments()
+    for verti, boneIndex, weight in assignments:
+        boneAssignments[0].append(verti)
+        boneAssignments[1].append(boneIndex)
+        boneAssignments[2].append(weight)
+    return boneAssignments
+
+def readDeclaration(geometryChunk):
+    # [(source, type, semantic, offset, index), ..] of packed geometry
+    reader = TLBinary.OgreBinaryReader(geometryChunk)
+    reader.readChunk()
+    reader.readUInt()
+    reader.readChunk()
+    declaration = []
+    while reader.peekChunkID() == TLBinary.M_GEOMETRY_VERTEX_ELEMENT:
+        reader.readChunk()
+        declaration.append(reader.unpack('5H', 10))
+    return declaration
+
+class BinaryFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def writeBytes(self, name, data):
+        fileWr = open(self.path(name), 'wb')
+        fileWr.write(data)
+        fileWr.close()
+        return self.path(name)
+
+    def assertGeometryEqual(self, read, written):
+        self.assertEqual(read['vertexcount'], written['vertexcount'])
+        readElements = dict(((semantic, index), (comps, values))
+                            for semantic, index, comps, values in read['elements'])
+        self.assertEqual(len(readElements), len(written['elements']))
+        for semantic, index, comps, values in written['elements']:
+            readComps, readValues = readElements[(semantic, index)]
+            self.assertEqual(readComps, comps)
+            if semantic == TLBinary.VES_DIFFUSE:
+                # colours are stored as bytes
+                for readValue, value in zip(readValues, values):
+                    self.assertAlmostEqual(readValue, value, places=6)
+            else:
+                self.assertEqual(list(readValues), list(values))
+
+class MeshTest(BinaryFileTestCase):
+
+    def roundTrip(self, ogreMesh, version):
+        filepath = self.path("test.mesh")
+        TLBinary.writeMesh(filepath, ogreMesh, version)
+        return TLBinary.readMesh(filepath)
+
+    def test_round_trip_versions(self):
+        for version in TLBinary.MESH_VERSIONS:
+            geometry = newGeometry(4)
+            ogreMesh = {'submeshes': [{'material': "box",
+                                       'usesharedvertices': False,
+                                       'indices': [0, 1, 2, 0, 2, 3],
+                                       'geometry': geometry}],
+                        'submeshnames': {0: "box"}}
+            read = self.roundTrip(ogreMesh, version)
+            self.assertEqual(read['version'], version)
+            self.assertEqual(read['submeshnames'], {0: "box"})
+            self.assertNotIn('skeletonlink', read)
+            subMesh = read['submeshes'][0]
+            self.assertEqual(subMesh['material'], "box")
+            self.assertFalse(subMesh['usesharedvertices'])
+            self.assertEqual(subMesh['operationtype'], TLBinary.OT_TRIANGLE_LIST)
+            self.assertEqual(subMesh['indices'].typecode, 'H')
+            self.assertEqual(list(subMesh['indices']), [0, 1, 2, 0, 2, 3])
+            self.assertGeometryEqual(subMesh['geometry'], geometry)
+            # bounds are calculated from positions
+            self.assertEqual(read['bounds'][0:6], [0.0, -0.75, 1.0, 1.5, 0.0, 1.0])
+
+    def test_32bit_indices(self):
+        vertexCount = 65537
+        geometry = newGeometry(vertexCount, texCoords=False)
+        indices = [0, 65535, 65536, 65536, 1, 0]
+        ogreMesh = {'submeshes': [{'material': "big",
+                                   'usesharedvertices': False,
+                                   'indices': indices,
+                                   'geometry': geometry}]}
+        read = self.roundTrip(ogreMesh, TLBinary.MESH_VERSION_TL2)
+        subMesh = read['submeshes'][0]
+        self.assertEqual(subMesh['indices'].typecode, 'I')
+        self.assertEqual(list(subMesh['indices']), indices)
+        self.assertGeometryEqual(subMesh['geometry'], geometry)
+
+    def test_vertex_colours_are_argb(self):
+        self.assertEqual(list(TLBinary.packColours([1.0, 0.0, 0.2, 0.6])),
+                         [(153 << 24) | (255 << 16) | 51])
+        geometry = newGeometry(6, colours=True)
+        ogreMesh = {'submeshes': [{'material': "coloured",
+                                   'usesharedvertices': False,
+                                   'indices': [0, 1, 2, 3, 4, 5],
+                                   'geometry': geometry}]}
+        read = self.roundTrip(ogreMesh, TLBinary.MESH_VERSION_TL1)
+        self.assertGeometryEqual(read['submeshes'][0]['geometry'], geometry)
+        declaration = readDeclaration(TLBinary.packGeometry(geometry, False))
+        types = dict((semantic, elemType) for source, elemType, semantic, offset, index in declaration)
+        self.assertEqual(types[TLBinary.VES_DIFFUSE], TLBinary.VET_COLOUR_ARGB)
+
+    def test_shared_geometry(self):
+        geometry = newGeometry(4)
+        ogreMesh = {'sharedgeometry': geometry,
+                    'boneassignments': newBoneAssignments([(0, 1, 0.5), (3, 0, 1.0)]),
+                    'submeshes': [{'material': "a", 'usesharedvertices': True,
+                                   'indices': [0, 1, 2]},
+                                  {'material': "b", 'usesharedvertices': True,
+                                   'indices': [0, 2, 3]}]}
+        read = self.roundTrip(ogreMesh, TLBinary.MESH_VERSION_TL2)
+        self.assertGeometryEqual(read['sharedgeometry'], geometry)
+        self.assertEqual([sm['material'] for sm in read['submeshes']], ["a", "b"])
+        for subMesh in read['submeshes']:
+            self.assertTrue(subMesh['usesharedvertices'])
+            self.assertNotIn('geometry', subMesh)
+        self.assertEqual(list(read['submeshes'][1]['indices']), [0, 2, 3])
+        vertexIndices, boneIndices, weights = read['boneassignments']
+        self.assertEqual(list(vertexIndices), [0, 3])
+        self.assertEqual(list(boneIndices), [1, 0])
+        self.assertEqual(list(weights), [0.5, 1.0])
+
+    def test_skinned_mesh_buffers(self):
+        geometry = newGeometry(3, colours=True)
+        ogreMesh = {'skeletonlink': "rig.skeleton",
+                    'submeshes': [{'material': "skin",
+                                   'usesharedvertices': False,
+                                   'indices': [0, 1, 2],
+                                   'geometry': geometry,
+                                   'boneassignments': newBoneAssignments(
+                                       [(0, 0, 1.0), (1, 0, 0.5), (1, 2, 0.5), (2, 2, 1.0)])}]}
+        read = self.roundTrip(ogreMesh, TLBinary.MESH_VERSION_TL1)
+        self.assertEqual(read['skeletonlink'], "rig.skeleton")
+        subMesh = read['submeshes'][0]
+        self.assertGeometryEqual(subMesh['geometry'], geometry)
+        vertexIndices, boneIndices, weights = subMesh['boneassignments']
+        self.assertEqual(list(vertexIndices), [0, 1, 1, 2])
+        self.assertEqual(list(boneIndices), [0, 0, 2, 2])
+        self.assertEqual(list(weights), [1.0, 0.5, 0.5, 1.0])
+        # positions and normals are in source 0, everything else in source 1
+        declaration = readDeclaration(TLBinary.packGeometry(geometry, True))
+        sources = dict((semantic, source) for source, elemType, semantic, offset, index in declaration)
+        self.assertEqual(sources, {TLBinary.VES_POSITION: 0, TLBinary.VES_NORMAL: 0,
+                                   TLBinary.VES_DIFFUSE: 1, TLBinary.VES_TEXTURE_COORDINATES: 1})
+
+    def test_malformed_chunk(self):
+        # unknown chunk with length shorter than chunk header
+        data = (struct.pack('<H', TLBinary.M_HEADER) + b"[MeshSerializer_v1.40]\n" +
+                struct.pack('<HI', TLBinary.M_MESH, 13) + b"\x00" +
+                struct.pack('<HI', TLBinary.M_EDGE_LISTS, 2))
+        filepath = self.writeBytes("broken.mesh", data)
+        self.assertRaises(TLBinary.OgreBinaryError, TLBinary.readMesh, filepath)
+
+    def test_truncated_mesh(self):
+        filepath = self.path("test.mesh")
+        TLBinary.writeMesh(filepath, {'submeshes': [{'material': "box",
+                                                     'usesharedvertices': False,
+                                                     'indices': [0, 1, 2],
+                                                     'geometry': newGeometry(3)}]})
+        fileIn = open(filepath, 'rb')
+        data = fileIn.read()
+        fileIn.close()
+        filepath = self.writeBytes("truncated.mesh", data[:len(data) // 2])
+        self.assertRaises(TLBinary.OgreBinaryError, TLBinary.readMesh, filepath)
+
+SKELETON = {
+    'bones': [{'name': "root", 'id': 0, 'position': [0.0, 0.0, 0.0],
+               'orientation': [1.0, 0.0, 0.0, 0.0]},
+              {'name': "arm", 'id': 1, 'position': [0.0, 1.5, 0.0],
+               'orientation': [0.5, 0.5, 0.5, 0.5], 'scale': [2.0, 2.0, 0.5]}],
+    'parents': {1: 0},
+    'animations': [{'name': "Idle", 'length': 1.0,
+                    'tracks': {0: [(0.0, [1.0, 0.0, 0.0, 0.0], [0.0, 0.0, 0.0], [1.0, 1.0, 1.0]),
+                                   (1.0, [0.5, 0.5, 0.5, 0.5], [0.0, 0.25, 0.0], [1.0, 1.0, 1.0])]}},
+                   {'name': "Grow", 'length': 0.5,
+                    'tracks': {1: [(0.5, [1.0, 0.0, 0.0, 0.0], [0.0, 0.0, 0.0], [2.0, 2.0, 2.0])]}}],
+    'animationlinks': [("other.skeleton", 0.5)],
+    }
+
+class SkeletonTest(BinaryFileTestCase):
+
+    def writeSkeleton(self):
+        filepath = self.path("rig.skeleton")
+        TLBinary.writeSkeleton(filepath, SKELETON)
+        return filepath
+
+    def test_round_trip(self):
+        read = TLBinary.readSkeleton(self.writeSkeleton())
+        self.assertEqual(read['version'], TLBinary.SKELETON_VERSION)
+        self.assertEqual(read['parents'], {1: 0})
+        self.assertEqual(read['animationlinks'], [("other.skeleton", 0.5)])
+        root, arm = read['bones']
+        self.assertEqual((root['name'], root['id']), ("root", 0))
+        self.assertEqual(root['orientation'], [1.0, 0.0, 0.0, 0.0])
+        self.assertEqual(arm['position'], [0.0, 1.5, 0.0])
+        self.assertEqual(arm['orientation'], [0.5, 0.5, 0.5, 0.5])
+        for animation, written in zip(read['animations'], SKELETON['animations']):
+            self.assertEqual(animation['name'], written['name'])
+            self.assertEqual(animation['length'], written['length'])
+            self.assertEqual(animation['tracks'], written['tracks'])
+
+    def test_optional_bone_scale(self):
+        root, arm = TLBinary.readSkeleton(self.writeSkeleton())['bones']
+        # unit scale isn't written
+        self.assertEqual(root['scale'], [1.0, 1.0, 1.0])
+        self.assertEqual(arm['scale'], [2.0, 2.0, 0.5])
+        unitScaled = dict(SKELETON['bones'][1], scale=[1.0, 1.0, 1.0])
+        self.assertEqual(len(TLBinary.packBone(SKELETON['bones'][1])),
+                         len(TLBinary.packBone(unitScaled)) + 12)
+
+    def test_animations_read_at_offsets(self):
+        filepath = self.writeSkeleton()
+        read = TLBinary.readSkeleton(filepath, loadAnimations=False)
+        # bones are read even when keyframes are skipped
+        self.assertEqual(len(read['bones']), 2)
+        self.assertEqual(read['animationlinks'], [("other.skeleton", 0.5)])
+        for animation, written in zip(read['animations'], SKELETON['animations']):
+            self.assertIsNone(animation['tracks'])
+            self.assertEqual(animation['name'], written['name'])
+            loaded = TLBinary.readAnimationAt(filepath, animation['offset'])
+            self.assertEqual(loaded['name'], written['name'])
+            self.assertEqual(loaded['offset'], animation['offset'])
+            self.assertEqual(loaded['tracks'], written['tracks'])
+
+    def test_animation_at_wrong_offset(self):
+        filepath = self.writeSkeleton()
+        offset = TLBinary.readSkeleton(filepath, loadAnimations=False)['animations'][0]['offset']
+        self.assertRaises(TLBinary.OgreBinaryError, TLBinary.readAnimationAt, filepath, offset + 2)
+
+if __name__ == "__main__":
+    unittest.main()
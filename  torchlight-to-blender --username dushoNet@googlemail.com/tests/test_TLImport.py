@@ -0,0 +1,182 @@
+"""
+Tests of TLImport parts which don't need Blender (run with pytest or
+unittest from this folder). bpy and mathutils are replaced by empty modules
+when not running inside Blender.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+if "bpy" not in sys.modules:
+    try:
+        import bpy
+    except ImportError:
+        sys.modules["bpy"] = types.ModuleType("bpy")
+        mathutils = types.ModuleType("mathutils")
+        mathutils.Vector = mathutils.Matrix = object
+        sys.modules["mathutils"] = mathutils
+
+import TLImport
+
+MESH_WITH_LOD = """<mesh>
+    <submeshes>
+        <submesh material="box" usesharedvertices="false" use32bitindexes="false" operationtype="triangle_list">
+            <faces count="2">
+                <face v1="0" v2="1" v3="2" />
+                <face v1="0" v2="2" v3="3" />
+            </faces>
+            <geometry vertexcount="4">
+                <vertexbuffer positions="true">
+                    <vertex><position x="0" y="0" z="0" /></vertex>
+                    <vertex><position x="1" y="0" z="0" /></vertex>
+                    <vertex><position x="1" y="1" z="0" /></vertex>
+                    <vertex><position x="0" y="1" z="0" /></vertex>
+                </vertexbuffer>
+            </geometry>
+        </submesh>
+    </submeshes>
+    <levelofdetail strategy="Distance" numlevels="2" manual="false">
+        <lodgenerated value="100">
+            <lodfacelist submeshindex="0" numfaces="1">
+                <face v1="0" v2="1" v3="2" />
+            </lodfacelist>
+        </lodgenerated>
+    </levelofdetail>
+</mesh>
+"""
+
+class XReadMeshTest(unittest.TestCase):
+
+    def readMesh(self, text):
+        fd, filename = tempfile.mkstemp(suffix=".mesh.xml")
+        fileWr = os.fdopen(fd, 'w')
+        fileWr.write(text)
+        fileWr.close()
+        try:
+            return TLImport.xReadMesh(filename)
+        finally:
+            os.unlink(filename)
+
+    def test_lod_face_lists_are_skipped(self):
+        ogreMesh = self.readMesh(MESH_WITH_LOD)
+        self.assertIsNotNone(ogreMesh)
+        self.assertEqual(len(ogreMesh['submeshes']), 1)
+        subMesh = ogreMesh['submeshes'][0]
+        self.assertEqual(list(subMesh['indices']), [0, 1, 2, 0, 2, 3])
+        self.assertEqual(subMesh['geometry']['vertexcount'], 4)
+
+class XCollectMaterialDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def writeFile(self, relativePath, text):
+        filepath = os.path.join(self.root, relativePath)
+        if not os.path.isdir(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath))
+        fileWr = open(filepath, 'w')
+        fileWr.write(text)
+        fileWr.close()
+        return filepath
+
+    def test_inherited_texture_is_relative_to_parent_file(self):
+        self.writeFile(os.path.join("shared", "base.material"),
+                       "material Base\n{\n technique\n {\n  pass\n  {\n"
+                       "   texture_unit\n   {\n    texture base.dds\n   }\n  }\n }\n}\n")
+        texture = self.writeFile(os.path.join("shared", "base.dds"), "")
+        materialFile = self.writeFile(os.path.join("mesh", "mesh.material"),
+                                      "material Child : Base\n{\n}\n")
+        meshData = {'submeshes': [{'material': 'Child', 'materialOrg': 'Child'}]}
+        TLImport.xCollectMaterialData(meshData, materialFile, self.root)
+        self.assertEqual(meshData['materials']['Child']['texture'], texture)
+
+class FakeAction:
+
+    def __init__(self, name):
+        self.name = name
+        self.users = 1
+        self.use_fake_user = True
+
+class FakeActions(dict):
+
+    def remove(self, action):
+        del self[action.name]
+
+class FakeRig(dict):
+
+    def __init__(self, name):
+        dict.__init__(self, tl_animation_index=name)
+        self.name = name
+        self.animation_data = types.SimpleNamespace(action=None)
+
+class ActivateAnimationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (getattr(TLImport, 'bpy'), TLImport.bBakeAnimation,
+                      TLImport.binLoadAnimation, TLImport.MAX_RESIDENT_ACTIONS)
+        self.actions = FakeActions()
+        TLImport.bpy = types.SimpleNamespace(data=types.SimpleNamespace(actions=self.actions))
+        TLImport.bBakeAnimation = self.bakeAnimation
+        TLImport.binLoadAnimation = lambda animation, boneIDs: {}
+        TLImport.MAX_RESIDENT_ACTIONS = 2
+        TLImport.residentActions.clear()
+        self.baked = 0
+        self.rig = FakeRig("Rig")
+        animations = {}
+        for name in ("Idle", "Walk", "Run", "Jump"):
+            animations[name] = {'name': name, 'file': "rig.skeleton", 'offset': 0,
+                                'scale': 1.0, 'tracks': None}
+        TLImport.animationIndex["Rig"] = {'skeleton': {}, 'boneIDs': {},
+                                          'animations': animations}
+
+    def tearDown(self):
+        (TLImport.bpy, TLImport.bBakeAnimation,
+         TLImport.binLoadAnimation, TLImport.MAX_RESIDENT_ACTIONS) = self.saved
+        TLImport.residentActions.clear()
+        del TLImport.animationIndex["Rig"]
+
+    def bakeAnimation(self, name, tracks, bonesData):
+        # bpy.data.actions.new adds numbered suffix to taken names
+        actionName = name
+        if actionName in self.actions:
+            actionName = "%s.%03d" % (name, len(self.actions))
+        self.actions[actionName] = FakeAction(actionName)
+        self.baked += 1
+        return self.actions[actionName]
+
+    def activate(self, name):
+        return TLImport.activateAnimation(self.rig, name)
+
+    def test_unreadable_animation_leaves_rig_without_action(self):
+        def failingLoad(animation, boneIDs):
+            raise TLImport.TLBinary.OgreBinaryError("Unexpected end of file")
+        TLImport.binLoadAnimation = failingLoad
+        self.assertIsNone(TLImport.activateAnimation(self.rig, "Idle"))
+        self.assertIsNone(self.rig.animation_data.action)
+        self.assertEqual(len(TLImport.residentActions), 0)
+
+    def test_used_action_stays_resident(self):
+        # "Walk" keeps a user (e.g. NLA strip) after it is deactivated
+        self.activate("Walk")
+        self.actions["Walk"].users = 2
+        for name in ("Idle", "Run", "Jump"):
+            self.activate(name)
+        self.assertIn("Walk", self.actions)
+        self.assertIn(("Rig", "Walk"), TLImport.residentActions)
+        baked = self.baked
+        self.assertIs(self.activate("Walk"), self.actions["Walk"])
+        self.assertEqual(self.baked, baked)
+        self.assertNotIn("Walk.001", self.actions)
+        self.assertEqual(sorted(self.actions.keys()), ["Jump", "Walk"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+"""
+Tests of TLMaterial (run with pytest or unittest from this folder).
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import TLMaterial
+
+MATERIAL_SCRIPT = """// header comment
+material Base
+{
+}
+
+material A : Base
+{
+    technique
+    {
+        pass
+        {
+            texture_unit
+            {
+                texture a.dds
+            }
+        }
+    }
+}
+"""
+
+def blockOffsets(block):
+    offsets = [block['offset']]
+    for listName in ('blocks', 'techniques', 'passes', 'textureunits'):
+        for nested in block.get(listName, []):
+            offsets.extend(blockOffsets(nested))
+    return offsets
+
+class ReadMaterialAtTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.folder, "test.material")
+        fileWr = open(self.filepath, 'w')
+        fileWr.write(MATERIAL_SCRIPT)
+        fileWr.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_nested_offsets_are_file_offsets(self):
+        material = TLMaterial.readMaterialFile(self.filepath)['A']
+        single = TLMaterial.readMaterialAt(self.filepath, material['offset'])
+        self.assertEqual(blockOffsets(single), blockOffsets(material))
+        passOffset = single['techniques'][0]['passes'][0]['offset']
+        self.assertEqual(MATERIAL_SCRIPT[passOffset:passOffset+4], "pass")
+
+class MaterialIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.walks = 0
+        self.walk = os.walk
+        def countingWalk(*args, **kwargs):
+            self.walks += 1
+            return self.walk(*args, **kwargs)
+        os.walk = countingWalk
+
+    def tearDown(self):
+        os.walk = self.walk
+        indexPath = TLMaterial.getIndexPath(os.path.abspath(self.root))
+        if os.path.isfile(indexPath):
+            os.unlink(indexPath)
+        shutil.rmtree(self.root)
+
+    def writeMaterials(self, filename, names, mtime):
+        filepath = os.path.join(self.root, filename)
+        fileWr = open(filepath, 'w')
+        for name in names:
+            fileWr.write("material %s\n{\n}\n" % name)
+        fileWr.close()
+        os.utime(filepath, (mtime, mtime))
+        return filepath
+
+    def findMaterial(self, name):
+        materialIndex = TLMaterial.loadMaterialIndex(self.root)
+        return TLMaterial.findMaterial(name, materialIndex, {})
+
+    def test_found_material_doesnt_walk_tree(self):
+        self.writeMaterials("a.material", ["A"], 1000)
+        self.assertIsNotNone(self.findMaterial("A"))
+        self.assertEqual(self.walks, 1)
+        self.assertIsNotNone(self.findMaterial("A"))
+        self.assertEqual(self.walks, 1)
+
+    def test_changed_file_is_rescanned(self):
+        self.writeMaterials("a.material", ["A"], 1000)
+        self.assertIsNotNone(self.findMaterial("A"))
+        filepath = self.writeMaterials("a.material", ["Other", "A"], 2000)
+        material = self.findMaterial("A")
+        self.assertEqual(material['offset'], len("material Other\n{\n}\n"))
+        self.assertEqual(material['file'], filepath)
+        self.assertEqual(self.walks, 1)
+
+    def test_missing_material_rescans_tree(self):
+        self.writeMaterials("a.material", ["A"], 1000)
+        self.assertIsNotNone(self.findMaterial("A"))
+        self.writeMaterials("b.material", ["B"], 1000)
+        self.assertIsNotNone(self.findMaterial("B"))
+        self.assertEqual(self.walks, 2)
+        self.assertIsNone(self.findMaterial("C"))
+        self.assertEqual(self.walks, 3)
+
+if __name__ == "__main__":
+    unittest.main()